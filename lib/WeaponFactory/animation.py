@@ -1,13 +1,20 @@
 import json
+import pygame
 
 from pygame import Rect
 
 from .core      import Engine
 from .resources import Resources
+from .text      import Text
 from .utils     import Config, log_ex
 
+# The frames of an animation are areas of a sheet. At zoom level N (see
+# `Camera`), they are taken from the sheet scaled down by 2^N, shared by all
+# the animations of the sheet.
 class Animation:
 
+    sheets = {}     # (sheet, zoom) -> Surface
+
     @classmethod
     def log(cls, msg):
         log_ex(msg, category=cls.__name__)
@@ -18,7 +25,8 @@ class Animation:
         self.height    = height
         self.surface   = surface
         self.frames    = frames
-        self.ratio     = Engine.singleton().fps / rate
+        self.areas     = {}     # zoom -> [Rect, …]
+        self.ratio     = Engine.singleton().tick_rate / rate
         self.is_loop   = is_loop
         self.last      = len(frames) - 1
         self.current   = 0
@@ -48,15 +56,37 @@ class Animation:
     def update(self):
         if self.is_paused or self.is_done():
             return
-        if Engine.singleton().frame_count % self.ratio != 0:
+        if Engine.singleton().tick_count % self.ratio != 0:
             return
         self.next_frame()
 
+    def sheet(self, zoom):
+        if zoom == 0:
+            return self.surface
+        key   = (self.surface, zoom)
+        sheet = Animation.sheets.get(key)
+        if sheet is None:
+            (w, h)                = self.surface.get_size()
+            sheet                 = pygame.transform.smoothscale(self.surface.convert_alpha(),
+                                                                 (w >> zoom, h >> zoom))
+            Animation.sheets[key] = sheet
+        return sheet
+
+    # Return the current frame at the zoom level centered at the coordinates,
+    # as a (source, dest, area) item of `Surface.blits`.
+    def frame_at(self, x, y, zoom=0):
+        (w, h) = (self.width >> zoom, self.height >> zoom)
+        areas  = self.areas.get(zoom)
+        if areas is None:
+            areas            = [Rect((fx >> zoom, fy >> zoom), (w, h))
+                                for (fx, fy) in self.frames]
+            self.areas[zoom] = areas
+        return (self.sheet(zoom),                   # source
+                (x - w // 2, y - h // 2),           # dest
+                areas[self.current])                # area
+
     def blit_at(self, surface, x, y):
-        (fx, fy) = self.frames[self.current]
-        surface.blit(self.surface,                                   # source
-                     (x - self.width // 2, y - self.height // 2),    # dest
-                     area=Rect((fx, fy), (self.width, self.height)))
+        return surface.blit(*self.frame_at(x, y))
         # FIXME
         # pyxel.blt(x - self.width // 2, y - self.height // 2,
         #           self.img, fx, fy, self.width, self.height, pyxel.COLOR_BLACK)
@@ -73,8 +103,8 @@ class AnimationManager:
         with open(path, "r") as cf:
             conf = json.loads(cf.read())
 
-            self.current = None
-            self.surface = Resources.singleton().image(conf["image"])
+            self.current             = None
+            (self.surface, self.xy0) = Resources.singleton().sheet(conf["image"])
 
             self.animations = {}
             for a_name, a_conf in conf["animations"].items():
@@ -85,7 +115,10 @@ class AnimationManager:
                          height=a_conf["height"],
                          is_loop=a_conf["is_loop"])
 
+    # The frames are relative to the sprite sheet, not to the atlas.
     def add(self, name, frames, rate=10, width=8, height=8, is_loop=True):
+        (x0, y0)              = self.xy0
+        frames                = [(fx + x0, fy + y0) for (fx, fy) in frames]
         self.animations[name] = Animation(name, width, height, self.surface,
                                           rate, is_loop, frames)
 
@@ -121,13 +154,19 @@ class AnimationManager:
     def update(self):
         self.current.update()
 
-    def blit_at(self, surface, x, y):
+    def frame_at(self, x, y, zoom=0):
         if self.current is None:
-            return
-        self.current.blit_at(surface, x, y)
+            return None
+        return self.current.frame_at(x, y, zoom)
 
-        if False:
-            if Config.singleton().must_log("Animation"):
-                # FIXME
-                # pyxel.text(x + 20, y + 1, f"A: {self.current.name}", 0)
-                raise NotImplementedError("Must replace pyxel.text")
+    def blit_at(self, surface, x, y):
+        if self.current is None:
+            return None
+        return self.current.blit_at(surface, x, y)
+
+    # Blit the name of the current animation next to the (x, y) screen
+    # coordinates, and return the rectangles drawn on.
+    def blit_overlay(self, surface, x, y):
+        if self.current is None or not Config.singleton().must_log("Animation"):
+            return []
+        return [Text.singleton().blit(surface, f"A: {self.current.name}", x + 20, y + 1)]
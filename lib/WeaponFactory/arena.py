@@ -1,16 +1,23 @@
+import numpy as np
 import pygame
 
 from pygame import Rect
 
-from .const      import OBSTACLE, SQUARE_SIZE, WALKABLE
+from .arenafile  import ArenaFile
+from .const      import OBSTACLE, SQUARE_SIZE
 from .input      import Mouse
-from .navigation import Compass
+from .navigation import Compass, Components, Landmarks, NavGrid
 from .resources  import Resources
 from .tilemap    import Tilemap
 from .utils      import Config, log_ex
 
+# The camera shows the arena at a zoom level: a square is SQUARE_SIZE pixels
+# wide on screen at level 0, then half as wide at each level above (see
+# `Tilemap.chunk_surface`). Its size, in squares, depends on the level.
 class Camera:
 
+    ZOOM_LEVELS = 3
+
     _singleton = None
 
     @classmethod
@@ -24,22 +31,52 @@ class Camera:
         log_ex(msg, category=cls.__name__)
 
     def __init__(self):
+        self.u    = 0
+        self.v    = 0
+        self.zoom = 0
+        self.resize()
+        self.show()
+
+    def resize(self):
         (screen_width, screen_height) = pygame.display.get_window_size()
 
         a           = Arena.singleton()
-        self.u      = 0
-        self.v      = 0
-        self.width  = screen_width  // SQUARE_SIZE
-        self.height = screen_height // SQUARE_SIZE
+        self.width  = screen_width  // self.square_size()
+        self.height = screen_height // self.square_size()
         self.lu     = a.width  - self.width  - 1
         self.lv     = a.height - self.height - 1
-        self.show()
+
+    # Return the size of a square on screen, in pixels.
+    def square_size(self):
+        return SQUARE_SIZE >> self.zoom
 
     def rect(self):
         return Rect(self.u, self.v, self.width, self.height)
 
     def show(self):
-        Camera.log(f"rect={self.rect()}")
+        Camera.log(f"rect={self.rect()} zoom={self.zoom}")
+
+    def zoom_in(self):
+        if self.zoom >= 1:
+            self.set_zoom(self.zoom - 1)
+
+    # Zoom out as long as the camera fits in the arena.
+    def zoom_out(self):
+        (screen_width, screen_height) = pygame.display.get_window_size()
+
+        a    = Arena.singleton()
+        size = SQUARE_SIZE >> (self.zoom + 1)
+        if self.zoom + 1 < Camera.ZOOM_LEVELS \
+           and screen_width // size <= a.width and screen_height // size <= a.height:
+            self.set_zoom(self.zoom + 1)
+
+    # Set the zoom level, the camera centered on the same square.
+    def set_zoom(self, zoom):
+        (u, v)    = (self.u + self.width // 2, self.v + self.height // 2)
+        self.zoom = zoom
+        self.resize()
+        self.centered_move(u, v)
+        self.show()
 
     def left(self):
         if self.u >= 1:
@@ -62,9 +99,9 @@ class Camera:
             Camera.log(f"down: rect={self.rect()}")
 
     def move(self, u, v):
-        (screen_width, screen_height) = pygame.display.get_window_size()
-        self.u                        = min(screen_width  - self.width,  max(0, u))
-        self.v                        = min(screen_height - self.height, max(0, v))
+        a      = Arena.singleton()
+        self.u = min(a.width  - self.width,  max(0, u))
+        self.v = min(a.height - self.height, max(0, v))
 
     def centered_move(self, u, v):
         self.move(u - self.width  // 2,
@@ -72,8 +109,136 @@ class Camera:
 
     def view(self, square):
         assert isinstance(square, Square)
-        return self.u <= square.u and square.u <= self.u + self.width \
-            and self.v <= square.v and square.v <= self.v + self.height
+        return self.view_at(square.u, square.v)
+
+    def view_at(self, u, v):
+        return self.u <= u and u <= self.u + self.width \
+            and self.v <= v and v <= self.v + self.height
+
+# A sparse spatial index of the entities of an arena: a uniform grid of
+# buckets, each one listing the entities standing in its square area. Only the
+# buckets holding entities exist, so both memory and queries scale with the
+# number of entities, not with the arena area.
+#
+# Queries return the entities in the row-major order of their squares, then in
+# arrival order, the order of a scan of the squares.
+class SpatialIndex:
+
+    BUCKET_SIZE = 16    # Squares per bucket side.
+
+    @classmethod
+    def log(cls, msg):
+        log_ex(msg, category=cls.__name__)
+
+    def __init__(self):
+        self.buckets = {}   # (bu, bv) -> [entity, …]
+        self.squares = {}   # entity -> (u, v)
+
+    def __len__(self):
+        return len(self.squares)
+
+    def bucket_of(self, u, v):
+        return (u // SpatialIndex.BUCKET_SIZE, v // SpatialIndex.BUCKET_SIZE)
+
+    def insert(self, entity, u, v):
+        assert entity not in self.squares
+        self.squares[entity] = (u, v)
+        self.buckets.setdefault(self.bucket_of(u, v), []).append(entity)
+
+    def remove(self, entity):
+        (u, v) = self.squares.pop(entity)
+        bucket = self.bucket_of(u, v)
+        self.buckets[bucket].remove(entity)
+        if len(self.buckets[bucket]) == 0:
+            del self.buckets[bucket]
+
+    def move(self, entity, u, v):
+        self.remove(entity)
+        self.insert(entity, u, v)
+
+    def square_of(self, entity):
+        return self.squares[entity]
+
+    # Return the (u, v) square of each entity, in no particular order.
+    def items(self):
+        return self.squares.items()
+
+    def sort(self, entities):
+        return sorted(entities, key=lambda e: self.squares[e][::-1])
+
+    # Return the entities on the square.
+    def at(self, u, v):
+        bucket = self.buckets.get(self.bucket_of(u, v), [])
+        return [e for e in bucket if self.squares[e] == (u, v)]
+
+    # Return the entities in the rectangle of squares.
+    def in_rect(self, rect):
+        (u0, v0) = (rect.x, rect.y)
+        (u1, v1) = (rect.x + rect.w, rect.y + rect.h)
+        (b0, c0) = self.bucket_of(u0, v0)
+        (b1, c1) = self.bucket_of(u1 - 1, v1 - 1)
+        if (b1 - b0 + 1) * (c1 - c0 + 1) <= len(self.buckets):
+            buckets = [self.buckets.get((bu, bv), []) for bv in range(c0, c1 + 1)
+                                                       for bu in range(b0, b1 + 1)]
+        else:
+            buckets = [bucket for ((bu, bv), bucket) in self.buckets.items()
+                       if b0 <= bu <= b1 and c0 <= bv <= c1]
+        entities = []
+        for bucket in buckets:
+            for e in bucket:
+                (u, v) = self.squares[e]
+                if u0 <= u < u1 and v0 <= v < v1:
+                    entities.append(e)
+        return self.sort(entities)
+
+    # Return the entities at most the radius (in squares) away from the
+    # square, the nearest first.
+    def within(self, u, v, radius):
+        r        = int(radius)
+        entities = self.in_rect(Rect(u - r, v - r, 2 * r + 1, 2 * r + 1))
+        d2       = lambda e: (self.squares[e][0] - u) ** 2 + (self.squares[e][1] - v) ** 2
+        return sorted([e for e in entities if d2(e) <= radius * radius], key=d2)
+
+# The strategic view with the entities of the arena over it, one pixel per
+# square: red if an entity of the square is selected, white otherwise.
+#
+# Built on first use, then kept in sync by the arena as entities spawn, move
+# or get selected: only the pixels of the squares involved are drawn again, so
+# that the strategic view is a single blit whatever the number of entities.
+class Minimap:
+
+    SELECTED   = (200, 0, 0)
+    UNSELECTED = (255, 255, 255)
+
+    @classmethod
+    def log(cls, msg):
+        log_ex(msg, category=cls.__name__)
+
+    def __init__(self, arena):
+        self.arena   = arena
+        self.surface = None
+
+    def get_surface(self):
+        if self.surface is None:
+            self.surface = self.arena.strategic_view().copy()
+            squares      = set(square for (_, square) in self.arena.entities.items())
+            for (u, v) in squares:
+                self.draw(u, v)
+            Minimap.log(f"Built: squares={len(squares)}")
+        return self.surface
+
+    # Draw the pixel of the square again, if built.
+    def draw(self, u, v):
+        if self.surface is None:
+            return
+        entities = self.arena.entities.at(u, v)
+        if len(entities) == 0:
+            color = self.arena.strategic_view().get_at((u, v))
+        elif any(e.is_selected for e in entities):
+            color = Minimap.SELECTED
+        else:
+            color = Minimap.UNSELECTED
+        self.surface.set_at((u, v), color)
 
 # An arena is the terrain with all its obstacles.
 class Arena:
@@ -89,27 +254,28 @@ class Arena:
     def log(cls, msg):
         log_ex(msg, category=cls.__name__)
 
-    def log_entities_matrix(self):
+    def log_entities(self):
         if not Config.singleton().must_log("Arena"):
             return
-        Arena.log(f"Entities Matrix {self.width}x{self.height}:")
-        for v in range(self.height):
-            for u in range(self.width):
-                    entities = self.entities_matrix[v][u]
-                    if len(entities) >= 1:
-                        msg = f"[{u}, {v}]"
-                        for entity in entities:
-                            msg += f" {entity.name}"
-                        Arena.log(msg)
+        Arena.log(f"Entities {self.width}x{self.height}:")
+        squares = {}
+        for (entity, square) in self.entities.items():
+            squares.setdefault(square, []).append(entity)
+        for (u, v) in sorted(squares, key=lambda square: square[::-1]):
+            msg = f"[{u}, {v}]"
+            for entity in squares[(u, v)]:
+                msg += f" {entity.name}"
+            Arena.log(msg)
 
     def log_obstacles_matrix(self):
         if not Config.singleton().must_log("Arena"):
             return
         Arena.log(f"Obstacles Matrix:")
+        obstacles_matrix = Compass.singleton().grid.view()
         for v in range(self.height):
             msg = ''
             for u in range(self.width):
-                    if self.obstacles_matrix[v][u] == OBSTACLE:
+                    if obstacles_matrix[v, u] == OBSTACLE:
                         msg += 'x'
                     else:
                         msg += ' '
@@ -122,77 +288,122 @@ class Arena:
         self.name = config["name"]
         Arena.log(f"name={self.name} square={SQUARE_SIZE}")
 
-        # Tilemap
-        self.tm                   = Tilemap(self.name)
+        # Compiled arena, compiled again when missing or outdated. The strategic
+        # view is generated from the tilemap, unless the arena comes with an
+        # image of its own.
+        tm_path       = Resources.locate("tilemap", f"{self.name}.tmx")
+        sv_path       = Resources.find("image", f"{self.name}-sv.png")
+        af_path       = ArenaFile.path_of(tm_path)
+        count         = config.get("landmarks", 8)
+        self.compiled = ArenaFile.load(af_path, {"landmark_count": count,
+                                                 "chunk_size":     Tilemap.CHUNK_SIZE,
+                                                 "sv_image":       sv_path is not None})
+        if self.compiled is None:
+            self.compiled = self.compile(af_path, sv_path, count)
+
+        # Tilemap, its chunks loaded on demand.
+        self.tm                   = Tilemap(self.name, self.compiled,
+                                            config.get("chunks", 64))
         (self.width, self.height) = self.tm.get_map_size()
 
-        # Strategic View
-        sv_path               = Resources.locate("image", f"{self.name}-sv.png")
-        self.sv               = pygame.image.load(sv_path)
-        (sv_width, sv_height) = self.sv.get_size()
-        Arena.log(f"sv: path={sv_path} size={sv_width}x{sv_height}")
+        # Strategic View, converted on first use (see `strategic_view`).
+        self.sv                   = None
+        (sv_height, sv_width, _)  = self.compiled.header["sections"]["sv"]["shape"]
+        Arena.log(f"sv: path={sv_path or '(generated)'} size={sv_width}x{sv_height}")
         assert sv_width  == self.width,  "SV image width must match tilemap width"
         assert sv_height == self.height, "SV image height must match tilemap height"
 
-        # Obstacles:
-        self.obstacles_matrix = [[WALKABLE] * self.width for i in range(self.height)]
-        for v in range(self.height):
-            for u in range(self.width):
-                if self.tm.is_obstacle(u, v, 0):
-                    self.obstacles_matrix[v][u] = OBSTACLE
+        # Terrain. Once the compass is created, the occupancy is recorded by its
+        # navigation grid alone (see `NavGrid`).
+        self.terrain = self.compiled.array("terrain")
         # self.log_obstacles_matrix()
 
-        self.entities_matrix = [[1] * self.width for i in range(self.height)]
-        for v in range(self.height):
-            for u in range(self.width):
-                    self.entities_matrix[v][u] = []
-        self.log_entities_matrix()
+        # Landmarks and component labels of the terrain, for the compass.
+        if count >= 1:
+            self.landmarks = Landmarks.load(self.compiled)
+        else:
+            self.landmarks = None
+        self.labels = self.compiled.array("components")
+
+        self.entities = SpatialIndex()
+        self.minimap  = Minimap(self)
+        self.log_entities()
+
+    # Compile the arena from its sources, the tilemap and the strategic view
+    # image if any, with the given number of landmarks, and store it to the
+    # path.
+    def compile(self, path, sv_path, count):
+        Arena.log(f"Compiling arena {self.name}…")
+        tm                     = Tilemap(self.name)
+        terrain                = tm.obstacles_matrix(0)
+        (info, sections)       = tm.sections()
+        sources                = tm.sources()
+        info["landmark_count"] = count
+        info["sv_image"]       = sv_path is not None
+        grid                   = NavGrid(terrain)
+        labels                 = Components(grid).labels
+        sections["terrain"]    = terrain
+        sections["components"] = np.frombuffer(labels, dtype=np.int32).reshape(terrain.shape)
+        if sv_path is None:
+            sections["sv"] = tm.strategic_view()
+        else:
+            sections["sv"] = ArenaFile.pixels(pygame.image.load(sv_path))
+            sources.append(sv_path)
+        if count >= 1:
+            (i, s) = Landmarks.compute(grid, count).sections()
+            info.update(i)
+            sections.update(s)
+        return ArenaFile.store(path, info, sources, sections)
+
+    def strategic_view(self):
+        if self.sv is None:
+            self.sv = ArenaFile.surface(self.compiled.array("sv"))
+        return self.sv
 
     def tile_data_from_mouse(self):
         return Square(0, 0).from_mouse().tile_data()
 
     def is_obstacle(self, square):
-        return self.obstacles_matrix[square.v][square.u] == OBSTACLE
+        return Compass.singleton().is_obstacle(square)
 
     def entities_at_square(self, u, v):
-        return self.entities_matrix[v][u]
+        return self.entities.at(u, v)
+
+    # Return the entities in the rectangle of squares.
+    def entities_in(self, rect):
+        return self.entities.in_rect(rect)
 
     def notify(self, event, observable, **kwargs):
         if event == "entity-spawned":
             self.entity_spawned(observable, kwargs["square"])
         elif event == "entity-moved":
             self.entity_moved(observable, kwargs["old_square"], kwargs["new_square"])
+        elif event == "entity-selected" or event == "entity-unselected":
+            self.minimap.draw(*self.entities.square_of(observable))
         else:
             raise AssertionError(f"Event not supported: {event}")
 
     def entity_spawned(self, entity, square):
         Arena.log(f"Entity {entity.name} spawned on {square}")
 
-        (u, v) = (square.u, square.v)
-        self.entities_matrix[v][u].append(entity)
-        self.obstacles_matrix[v][u] = OBSTACLE
-        Compass.singleton().set_obstacle(square)
+        self.entities.insert(entity, square.u, square.v)
+        self.minimap.draw(square.u, square.v)
+        Compass.singleton().occupy(square, entity)
         Arena.log(f"Obstacle at square {square}")
-        self.log_entities_matrix()
+        self.log_entities()
 
     def entity_moved(self, entity, old_square, new_square):
         Arena.log(f"Entity {entity.name} moved from {old_square} to {new_square}")
 
-        (ou, ov) = (old_square.u, old_square.v)
-        self.entities_matrix[ov][ou].remove(entity)
-        if (len(self.entities_matrix[ov][ou]) == 0):
-            self.obstacles_matrix[ov][ou] = WALKABLE
-            Compass.singleton().set_walkable(old_square)
-            Arena.log(f"No more obstacle at square {old_square}")
+        (u, v) = self.entities.square_of(entity)
+        self.entities.move(entity, new_square.u, new_square.v)
+        assert len(self.entities.at(new_square.u, new_square.v)) == 1, \
+            "Stacking not allowed for now"
+        self.minimap.draw(u, v)
+        self.minimap.draw(new_square.u, new_square.v)
 
-        (nu, nv) = (new_square.u, new_square.v)
-        self.entities_matrix[nv][nu].append(entity)
-        assert len(self.entities_matrix[nv][nu]) == 1, "Stacking not allowed for now"
-
-        self.obstacles_matrix[nv][nu] = OBSTACLE
-        Compass.singleton().set_obstacle(new_square)
-        Arena.log(f"Obstacle at square {new_square}")
-        self.log_entities_matrix()
+        Compass.singleton().move(entity, old_square, new_square)
+        self.log_entities()
 
 class ArenaView:
 
@@ -222,7 +433,7 @@ class ArenaView:
         return Arena.singleton().tm
 
     def get_strategic_view(self):
-        return Arena.singleton().sv
+        return Arena.singleton().strategic_view()
 
     def tactical(self):
         self.is_tactical = True
@@ -238,22 +449,22 @@ class ArenaView:
 
     def update(self):
         if self.is_tactical:
+            self.get_tilemap().prefetch(Camera.singleton().rect())
             Region.singleton().update()
 
     def blit_tactical(self, surface):
         c = Camera.singleton()
-        self.get_tilemap().blit_layer(c.rect(), 0, surface)
-        Region.singleton().blit(surface)
+        self.get_tilemap().blit_layer(c.rect(), 0, surface, c.zoom)
 
     def blit_strategic(self, surface):
 
-        # Blit the view itself.
+        # Blit the view itself, the entities on it (see `Minimap`).
         (screen_width, screen_height) = pygame.display.get_window_size()
-        sv                            = self.get_strategic_view()
-        (w, h)                        = sv.get_size()
+        minimap                       = Arena.singleton().minimap.get_surface()
+        (w, h)                        = minimap.get_size()
         x                             = (screen_width  - w) // 2
         y                             = (screen_height - h) // 2
-        surface.blit(sv, Rect((x, y), (w, h)))
+        surface.blit(minimap, Rect((x, y), (w, h)))
 
         # Blit the rectangle corresponding to the camera.
         c = Camera.singleton()
@@ -261,22 +472,6 @@ class ArenaView:
                          Rect((c.u, c.v), (c.width, c.height)),
                          width=1)
 
-        # FIXME
-        return
-
-        (screen_width, screen_height) = pygame.display.get_window_size()
-        for v in range(0, screen_height):
-            for u in range(0, screen_width):
-                entities = Arena.singleton().entities_at_square(u, v)
-                if len(entities) >= 1:
-                    for e in entities:
-                        # FIXME
-                        # if e.isSelected:
-                        #     pyxel.pset(u, v, 9)
-                        # else:
-                        #     pyxel.pset(u, v, 13)
-                        raise NotImplementedError("Must replace pyxel.pset")
-
     def blit(self, surface):
         if self.is_tactical:
             self.blit_tactical(surface)
@@ -292,10 +487,10 @@ class Point:
 
     def __init__(self, x, y):
         if __debug__:
-            (screen_width, screen_height) = pygame.display.get_window_size()
-            if 0 > x or x > screen_width*SQUARE_SIZE-1:
+            a = Arena.singleton()
+            if 0 > x or x > a.width*SQUARE_SIZE-1:
                 raise AssertionError()
-            if 0 > y or y > screen_height*SQUARE_SIZE-1:
+            if 0 > y or y > a.height*SQUARE_SIZE-1:
                 raise AssertionError()
         (self.x, self.y) = (x, y)
 
@@ -309,19 +504,19 @@ class Point:
     def square(self):
         return Square(self.x // SQUARE_SIZE, self.y // SQUARE_SIZE)
 
-    # Return the point in screen coordinates.
+    # Return the point in screen coordinates, at the zoom level of the camera.
     def screen(self):
         assert self.is_visible()
         c = Camera.singleton()
-        return Point(self.x - (c.u * SQUARE_SIZE),
-                     self.y - (c.v * SQUARE_SIZE))
+        return Point((self.x - (c.u * SQUARE_SIZE)) // (1 << c.zoom),
+                     (self.y - (c.v * SQUARE_SIZE)) // (1 << c.zoom))
 
     # Move to the coordinates pointed by the mouse.
     def from_mouse(self):
         (mx, my) = Mouse.get_coords()
         c        = Camera.singleton()
-        self.x   = c.u * SQUARE_SIZE + mx
-        self.y   = c.v * SQUARE_SIZE + my
+        self.x   = c.u * SQUARE_SIZE + (mx << c.zoom)
+        self.y   = c.v * SQUARE_SIZE + (my << c.zoom)
         return self
 
     # Tell if the point is visible from current camera's position.
@@ -338,10 +533,10 @@ class Square:
         u = int(u)
         v = int(v)
         if __debug__:
-            (screen_width, screen_height) = pygame.display.get_window_size()
-            if 0 > u or u > screen_width-1:
+            a = Arena.singleton()
+            if 0 > u or u > a.width-1:
                 raise AssertionError()
-            if 0 > v or v > screen_height-1:
+            if 0 > v or v > a.height-1:
                 raise AssertionError()
 
         (self.u, self.v)   = (u, v)
@@ -374,7 +569,8 @@ class Square:
 
     def from_mouse(self):
         (mx, my) = Mouse.get_coords()
-        (mu, mv) = (mx // SQUARE_SIZE, my // SQUARE_SIZE)
+        size     = Camera.singleton().square_size()
+        (mu, mv) = (mx // size, my // size)
         self.relative_move(mu, mv)
         return self
 
@@ -400,8 +596,12 @@ class Square:
         dv = abs(self.v - other_square.v)
         return du <= 1 and dv <= 1
 
+# The selection region, a rectangle of squares dragged with the mouse. A click
+# picks the entity the nearest to the square, if close enough.
 class Region:
 
+    PICK_RADIUS = 1.5   # squares
+
     _singleton = None
 
     @classmethod
@@ -444,7 +644,7 @@ class Region:
             return None
 
     def is_empty(self):
-        self.end is None or self.start == self.end
+        return self.end is None or self.start == self.end
 
     def update(self):
         if not self.is_enabled:
@@ -471,29 +671,35 @@ class Region:
 
     def blit(self, surface):
         if not self.is_enabled:
-            return
+            return []
 
         # Draw the square-level region
-        o  = self.get_origin().point().screen()
-        hs = SQUARE_SIZE // 2
+        o    = self.get_origin().point().screen()
+        size = Camera.singleton().square_size()
+        hs   = size // 2
         Region.log(f"origin={o}")
 
         rect = Rect((o.x - hs, o.y - hs),
-                    (self.get_width() * SQUARE_SIZE, self.get_height() * SQUARE_SIZE))
-        pygame.draw.rect(surface, (200, 0, 0), rect, width=1)
+                    (self.get_width() * size, self.get_height() * size))
+        return [pygame.draw.rect(surface, (200, 0, 0), rect, width=1)]
 
     # Return the entities that are part of the region.
     def get_entities(self):
+        a = Arena.singleton()
+        if self.is_empty():
+            entities = a.entities.within(self.start.u, self.start.v, Region.PICK_RADIUS)[:1]
+            Region.log(f"entities={entities}")
+            return entities
+
         entities = []
+        squares  = set()
         o        = self.get_origin()
-        a        = Arena.singleton()
-        for v in range(o.v, o.v + self.get_height()):
-            for u in range(o.u, o.u + self.get_width()):
-                e = a.entities_at_square(u, v)
-                Region.log(f"e={e} len(e)={len(e)}")
-                if len(e) >= 1:
-                    # If at least one entity is on the square, add only the
-                    # first one to handle stacking.
-                    entities.append(e[0])
+        for e in a.entities_in(Rect(o.u, o.v, self.get_width(), self.get_height())):
+            # If several entities are on the square, add only the first one to
+            # handle stacking.
+            square = a.entities.square_of(e)
+            if square not in squares:
+                squares.add(square)
+                entities.append(e)
         Region.log(f"entities={entities}")
         return entities
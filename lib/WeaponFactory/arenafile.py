@@ -0,0 +1,144 @@
+import json
+import mmap
+import numpy as np
+import os
+import os.path
+import pygame
+
+from hashlib import sha256
+
+from .utils import log_ex
+
+# A compiled arena: everything the arena needs at startup, stored in a single
+# file next to its tilemap (see `Arena`), so later starts load it without
+# parsing anything.
+#
+# The file is a JSON header line followed by raw sections, each one a NumPy
+# array whose offset, type and shape are given by the header. Loading the file
+# maps it in memory: the sections are views of the mapping, not copies.
+#
+# The header also lists the source files the arena was compiled from, with
+# their hashes. The file is outdated as soon as one of them changed.
+class ArenaFile:
+
+    MAGIC     = "wf-arena-1"
+    ALIGNMENT = 16      # Bytes. Sections start at a multiple of it.
+
+    @classmethod
+    def log(cls, msg):
+        log_ex(msg, category=cls.__name__)
+
+    def __init__(self, header, buffer):
+        self.header = header
+        self.buffer = buffer    # The mapping, or the bytes of a file not stored.
+
+    # Return the path of the compiled arena of the tilemap.
+    @classmethod
+    def path_of(cls, tilemap_path):
+        return f"{os.path.splitext(tilemap_path)[0]}.wfarena"
+
+    @classmethod
+    def digest(cls, path):
+        with open(path, "rb") as f:
+            return sha256(f.read()).hexdigest()
+
+    # Return the compiled arena stored at the path, or None if missing or
+    # outdated. The info it was stored with must include the given one.
+    @classmethod
+    def load(cls, path, info):
+        try:
+            with open(path, "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            header = json.loads(buffer[:buffer.find(b"\n")])
+            if header["magic"] != ArenaFile.MAGIC \
+               or any(header["info"].get(k) != v for (k, v) in info.items()):
+                ArenaFile.log(f"Outdated arena: {path}")
+                return None
+            base = os.path.dirname(path)
+            for (source, digest) in header["sources"]:
+                if ArenaFile.digest(os.path.join(base, source)) != digest:
+                    ArenaFile.log(f"Outdated arena: {path}: {source} changed")
+                    return None
+        except (OSError, ValueError, KeyError) as e:
+            ArenaFile.log(f"Cannot load arena from {path}: {e}")
+            return None
+        ArenaFile.log(f"Loaded arena from {path}")
+        return cls(header, buffer)
+
+    # Store the info (a JSON object) and the sections (name -> array) compiled
+    # from the source files, and return the compiled arena. It lives in memory
+    # only if it cannot be stored.
+    @classmethod
+    def store(cls, path, info, sources, sections):
+        base    = os.path.dirname(path)
+        header  = {"magic":    ArenaFile.MAGIC,
+                   "info":     info,
+                   "sources":  [[os.path.relpath(s, base), ArenaFile.digest(s)]
+                                for s in sources],
+                   "sections": {}}
+
+        # The offsets depend on the length of the header line, which depends
+        # on the offsets: lay the sections out again until the line fits.
+        start = 0
+        while True:
+            offset = start
+            for (name, a) in sections.items():
+                offset = -(-offset // ArenaFile.ALIGNMENT) * ArenaFile.ALIGNMENT
+                header["sections"][name] = {"offset": offset,
+                                            "dtype":  a.dtype.str,
+                                            "shape":  list(a.shape)}
+                offset += a.nbytes
+            line = json.dumps(header).encode() + b"\n"
+            if len(line) <= start:
+                break
+            start = len(line)
+
+        buffer             = bytearray(offset)
+        buffer[:len(line)] = line
+        for (name, a) in sections.items():
+            i                     = header["sections"][name]["offset"]
+            buffer[i:i + a.nbytes] = np.ascontiguousarray(a).tobytes()
+
+        try:
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(buffer)
+            os.replace(f"{path}.tmp", path)
+            ArenaFile.log(f"Stored arena to {path}")
+        except OSError as e:
+            ArenaFile.log(f"Cannot store arena to {path}: {e}")
+            return cls(header, bytes(buffer))
+        return cls.load(path, info) or cls(header, bytes(buffer))
+
+    # Return the section as a read-only array over the file.
+    def array(self, name):
+        section = self.header["sections"][name]
+        dtype   = np.dtype(section["dtype"])
+        count   = int(np.prod(section["shape"]))
+        return np.frombuffer(self.buffer, dtype=dtype, count=count,
+                             offset=section["offset"]).reshape(section["shape"])
+
+    # Return the section as a flat memoryview over the file, of the given
+    # array module type code.
+    def memoryview(self, name, typecode):
+        section = self.header["sections"][name]
+        size    = int(np.prod(section["shape"])) * np.dtype(section["dtype"]).itemsize
+        start   = section["offset"]
+        return memoryview(self.buffer)[start:start + size].cast(typecode)
+
+    # Return a surface of the (height, width, 4) RGBA pixels, converted to the
+    # display format.
+    @classmethod
+    def surface(cls, pixels):
+        (h, w, _) = pixels.shape
+        surface   = pygame.image.frombuffer(np.ascontiguousarray(pixels), (w, h), "RGBA")
+        if pixels[:, :, 3].min() == 255:
+            return surface.convert()
+        else:
+            return surface.convert_alpha()
+
+    # Return the (height, width, 4) RGBA pixels of the surface.
+    @classmethod
+    def pixels(cls, surface):
+        (w, h) = surface.get_size()
+        return np.frombuffer(pygame.image.tobytes(surface, "RGBA"),
+                             dtype=np.uint8).reshape(h, w, 4)
@@ -2,10 +2,11 @@ import os.path
 import pygame
 
 from .arena      import Arena, Square, ArenaView, Camera, Region
-from .const      import SCREEN_WIDTH, SCREEN_HEIGHT
+from .const      import SCREEN_WIDTH, SCREEN_HEIGHT, SQUARE_SIZE
 from .input      import ModalInputHandler, Mouse
 from .navigation import Compass, NavBeacon
 from .resources  import Resources
+from .text       import Text
 from .utils      import Config, log_ex
 
 COLOR_BLUE = (0, 0, 200)
@@ -36,11 +37,27 @@ class Engine:
         else:
             self.profile = None
 
-        config         = Config.singleton().load("engine.json")
-        self.fps       = config["fps"]
-        arena_config   = config["arena"]
-        arena_name     = arena_config["name"]
-        self.resources = Resources()
+        config              = Config.singleton().load("engine.json")
+        self.fps            = config["fps"]                     # Frames per s, at most.
+        self.tick_rate      = config.get("tick_rate", self.fps) # Ticks per s.
+        self.max_ticks      = config.get("max_ticks", 5)        # Ticks per frame, at most.
+        self.tick_count     = 0
+        self.frame_count    = 0
+        self.alpha          = 1.0                               # See `run`.
+        self.group_move_min = config.get("group_move_min", 2)
+        self.plan_budget    = config.get("plan_budget", 5000)   # µs per frame
+        self.plan_debug     = False                             # Planning stats shown.
+        self.plan_workers   = config.get("plan_workers", 0)
+        self.path_cache     = config.get("path_cache", 256)
+        self.field_cache    = config.get("field_cache", 16)
+        self.path_smoothing = config.get("path_smoothing", False)
+        self.dirty_rects    = config.get("dirty_rects", False)
+        self.view_key       = None      # (is_tactical, u, v, zoom), last frame.
+        self.dirty          = []        # Rectangles of the scene, last frame.
+        self.update_rects   = None      # Rectangles to update, None for all.
+        arena_config        = config["arena"]
+        arena_name          = arena_config["name"]
+        self.resources      = Resources()
 
         pygame.init()
 
@@ -73,6 +90,7 @@ class Engine:
             ps.print_stats()
             with open("wf.pstats", "w") as f:
                 f.write(s.getvalue())
+        Compass.singleton().quit()
         self.is_running = False
 
     def init_input(self):
@@ -90,6 +108,12 @@ class Engine:
             self.debug_data = Square(0, 0).from_mouse()
         ih.addFunc("debug_square_coordinates_from_mouse", debug_square_coordinates_from_mouse)
 
+        # DEBUG
+        def debug_planning_stats():
+            self.plan_debug = not self.plan_debug
+            self.debug_data = None
+        ih.addFunc("debug_planning_stats", debug_planning_stats)
+
         # Moving the camera
         def camera_up():
             Camera.singleton().up()
@@ -103,6 +127,12 @@ class Engine:
         def camera_right():
             Camera.singleton().right()
         ih.addFunc("camera_right", camera_right)
+        def camera_zoom_in():
+            Camera.singleton().zoom_in()
+        ih.addFunc("camera_zoom_in", camera_zoom_in)
+        def camera_zoom_out():
+            Camera.singleton().zoom_out()
+        ih.addFunc("camera_zoom_out", camera_zoom_out)
         def camera_to_mouse():
             (mx, my) = Mouse.get_coords()
             Camera.singleton().centered_move(mx, my)
@@ -118,17 +148,13 @@ class Engine:
         def tactical_move_to_mouse():
             self.nav_beacon.from_mouse()
             if self.nav_beacon.is_enabled:
-                for entity in self.selected_entities:
-                    Compass.singleton() \
-                           .navigate(entity, self.nav_beacon.square)
+                self.move_selection(self.nav_beacon.square)
         ih.addFunc("tactical_move_to_mouse", tactical_move_to_mouse)
 
         def strategic_move_to_mouse():
             (mx, my) = Mouse.get_coords()
             if self.nav_beacon.try_move( Square(mx, my) ):
-                for entity in self.selected_entities:
-                    path_found = Compass.singleton() \
-                                        .navigate(entity, self.nav_beacon.square)
+                self.move_selection(self.nav_beacon.square)
         ih.addFunc("strategic_move_to_mouse", strategic_move_to_mouse)
 
         # Region
@@ -158,9 +184,24 @@ class Engine:
         entity.select()
         self.selected_entities.append(entity)
 
+    # Move the selected entities to the square. A group shares a single flow
+    # field instead of running one search per entity. Planning is spread over
+    # the next frames (see `update_planning`).
+    def move_selection(self, square):
+        c = Compass.singleton()
+        if len(self.selected_entities) >= self.group_move_min:
+            c.request_group(self.selected_entities, square)
+        else:
+            for entity in self.selected_entities:
+                c.request(entity, square)
+
     def init_scene(self, arena_config):
         a = Arena(arena_config)
-        Compass(a.obstacles_matrix)
+        Compass(a.terrain, workers=self.plan_workers,
+                cache_size=self.path_cache, fields_size=self.field_cache,
+                landmarks=a.landmarks, labels=a.labels,
+                finder=arena_config.get("finder", "astar"),
+                smoothing=self.path_smoothing)
 
         # Spawn some drones
         drones = {
@@ -179,55 +220,133 @@ class Engine:
 
     def update(self):
         self.input_handler.probe()
+        self.tick()
+
+    # Advance the simulation by one tick, planning for `budget` µs (the whole
+    # plan budget by default). Return the µs used by planning.
+    def tick(self, budget=None):
+        used = self.update_planning(self.plan_budget if budget is None else budget)
         self.update_scene()
+        self.tick_count += 1
+        return used
+
+    # Nothing is planned once the budget is spent. The stats of the last tick
+    # are shown in the debug overlay when enabled (see `debug_planning_stats`).
+    def update_planning(self, budget):
+        if budget <= 0:
+            return 0
+        (queue, used) = Compass.singleton().update(budget)
+        stats         = f"Planning: queue={queue} used={used}/{budget}µs"
+        if used >= 1:
+            Engine.log(stats)
+        if self.plan_debug:
+            self.debug_data = stats
+        return used
 
     def update_scene(self):
         ArenaView.singleton().update()
         for entity in self.entities:
             entity.update()
 
+    # Draw the frame, and set the rectangles of the screen to update (see
+    # `flip`).
+    #
+    # In dirty rectangles mode, as long as the view and the camera do not
+    # change, the arena view is only drawn again over the rectangles the scene
+    # was drawn on the last frame, then the scene is drawn: only both sets of
+    # rectangles are updated. The strategic view is always drawn in full.
     def draw(self):
-        self.screen.fill(COLOR_BLUE)
-        self._blit_scene(self.screen)
-        self._blit_debug_data(self.screen)
+        av       = ArenaView.singleton()
+        c        = Camera.singleton()
+        view_key = (av.is_tactical, c.u, c.v, c.zoom)
+        if self.dirty_rects and av.is_tactical and view_key == self.view_key:
+            for rect in self.dirty:
+                self.screen.set_clip(rect)
+                self.screen.fill(COLOR_BLUE)
+                av.blit(self.screen)
+            self.screen.set_clip(None)
+            rects             = self._blit_scene(self.screen)
+            self.update_rects = self.dirty + rects
+        else:
+            self.screen.fill(COLOR_BLUE)
+            av.blit(self.screen)
+            rects             = self._blit_scene(self.screen)
+            self.update_rects = None
+        self.dirty    = rects
+        self.view_key = view_key
+
+    def flip(self):
+        if self.update_rects is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.update_rects)
 
+    # Blit the scene over the arena view, and return the rectangles drawn on.
+    # The frames of the visible entities are blitted at once.
     def _blit_scene(self, surface):
-        av = ArenaView.singleton()
-        av.blit(surface)
-        if av.is_tactical:
+        rects = []
+        if ArenaView.singleton().is_tactical:
+            rects   += Region.singleton().blit(surface)
             c        = Camera.singleton()
-            entities = []
-            a        = Arena.singleton()
-            for v in range(c.v, c.v + c.height):
-                for u in range(c.u, c.u + c.width):
-                    entities.extend( a.entities_at_square(u, v) )
-            for e in entities:
-                e.blit_nav_path(surface)
-            for e in entities:
-                e.blit_selection(surface)
-            for e in entities:
-                e.blit(surface)
+            entities = Arena.singleton().entities_in(c.rect())
+            visible  = self._visible_entities(entities)
             for e in entities:
-                e.blit_overlay(surface)
-        self.input_handler.blit(surface)
+                rects += e.blit_nav_path(surface)
+            for (e, x, y) in visible:
+                rects += e.blit_selection(surface, x, y, c.zoom)
+            frames   = [e.frame_at(x, y, c.zoom) for (e, x, y) in visible]
+            rects   += surface.blits([f for f in frames if f is not None])
+            for (e, x, y) in visible:
+                rects += e.blit_overlay(surface, x, y)
+        rects += self.input_handler.blit(surface)
+        rects += self._blit_debug_data(surface)
+        return rects
+
+    # Return the (entity, x, y) screen coordinates of the entities visible
+    # from the camera, at its zoom level, computed once per frame from their
+    # interpolated positions.
+    def _visible_entities(self, entities):
+        c        = Camera.singleton()
+        (ox, oy) = (c.u * SQUARE_SIZE, c.v * SQUARE_SIZE)
+        visible  = []
+        for e in entities:
+            (x, y) = e.interpolate(self.alpha)
+            if c.view_at(x // SQUARE_SIZE, y // SQUARE_SIZE):
+                visible.append((e, (x - ox) // (1 << c.zoom), (y - oy) // (1 << c.zoom)))
+        return visible
 
     def _blit_debug_data(self, surface):
         if self.debug_data is None:
-            return
-
-        # FIXME
-        # pyxel.text(0, 0, f"{self.debug_data}", pyxel.COLOR_BLACK)
-        raise NotImplementedError("Must replace pyxel.text")
-
+            return []
+        return [surface.blit(Text.singleton().render(f"{self.debug_data}"), (0, 0))]
+
+    # The simulation advances at a fixed rate, tick_rate ticks per second,
+    # whatever the frame rate: each frame runs the ticks due since the last
+    # one, then draws the entities where they are between the last two ticks
+    # (see `alpha`). Under load, the ticks run late, up to max_ticks per frame:
+    # beyond that, the simulation slows down rather than falling further
+    # behind. The plan budget is per frame: each tick plans with what the
+    # previous ones left.
     def run(self):
         clock            = pygame.time.Clock()
+        tick_ms          = 1000 / self.tick_rate
+        lag              = 0            # ms of simulation due.
         self.is_running  = True
         self.frame_count = 0
         while self.is_running:
-            self.update()
+            self.input_handler.probe()
+            ticks  = 0
+            budget = self.plan_budget
+            while lag >= tick_ms and ticks < self.max_ticks and self.is_running:
+                budget -= self.tick(budget)
+                lag    -= tick_ms
+                ticks  += 1
+            if ticks == self.max_ticks:
+                lag = min(lag, tick_ms)
+            self.alpha = min(lag / tick_ms, 1.0)
             self.draw()
-            pygame.display.flip()
+            self.flip()
             self.frame_count += 1
-            clock.tick(self.fps)
+            lag              += clock.tick(self.fps)
 
 from .drone import Drone
@@ -5,6 +5,7 @@ import pygame
 
 from pygame import Rect
 
+from .text  import Text
 from .utils import Config, log_ex
 
 # A key is a keyboard key. Its name starts with KEY_, e.g., KEY_F1.
@@ -119,11 +120,9 @@ class InputHandler:
         pygame.draw.rect(surface, self.background_color, Rect((x, y), (width, height)))
         pygame.draw.rect(surface, self.foreground_color, Rect((x, y), (width, height)),
                          width=1)
-        font      = pygame.font.Font(None, 15)
-        text_surf = font.render(self.abbrev,
-                                False,                 # Antialias
-                                self.foreground_color)
+        text_surf = Text.singleton().render(self.abbrev, 15, self.foreground_color)
         surface.blit(text_surf, (x + 2, y + 2))
+        return [Rect((x, y), (width, height))]
 
 class ModalInputHandler:
 
@@ -171,7 +170,7 @@ class ModalInputHandler:
         self.currentInputHandler.probe()
 
     def blit(self, surface):
-        self.currentInputHandler.blit(surface)
+        return self.currentInputHandler.blit(surface)
 
 class Mouse:
 
@@ -1,20 +1,1518 @@
+import numpy as np
 import pygame
 
-from pygame import Rect
+from array                         import array
+from collections                   import OrderedDict, deque
+from concurrent.futures            import ProcessPoolExecutor
+from heapq                         import heappop, heappush
+from math                          import sqrt
+from multiprocessing.shared_memory import SharedMemory
+from pygame                        import Rect
+from time                          import perf_counter
 
-# Path Finding:
-from pathfinding.core.diagonal_movement import DiagonalMovement
-from pathfinding.core.grid              import Grid
-from pathfinding.finder.finder          import ExecutionTimeException
+from .const import OBSTACLE, SQUARE_SIZE, WALKABLE
+from .utils import Config, log_ex
+
+# Run a search to completion and return its result. A search is a generator
+# that may yield between slices of work (see `Compass.update`) and returns its
+# result.
+def complete(search):
+    while True:
+        try:
+            next(search)
+        except StopIteration as stop:
+            return stop.value
 
-from math import sqrt
+# A navigation grid is the occupancy of the arena, in flat, row-major layers of
+# one byte per square. Square [u, v] is stored at index v * width + u.
+# - terrain: WALKABLE or OBSTACLE, from the tilemap. Static.
+# - units:   the number of entities standing on the square.
+# - cells:   WALKABLE only if the terrain is and no entity stands there,
+#            OBSTACLE otherwise. This is the layer the searches read.
+#
+# The grid is the only record of the occupancy: the arena and the compass read
+# its layers in place (see `view`), and writes go through `occupy` and `vacate`,
+# which keep the cells in line with the other layers.
+#
+# A shared grid lives in a shared memory block other processes can attach to
+# (see `attach`). Only the cells are shared.
+class NavGrid:
 
-from .const import SQUARE_SIZE
-from .utils import Config, log_ex
+    def __init__(self, terrain, shared=False):
+        matrix                    = np.asarray(terrain, dtype=np.uint8)
+        (self.height, self.width) = matrix.shape
+        self.terrain              = matrix.tobytes()
+        self.units                = bytearray(self.width * self.height)
+        if shared:
+            self.shm   = SharedMemory(create=True, size=self.width * self.height)
+            self.cells = self.shm.buf
+        else:
+            self.shm   = None
+            self.cells = bytearray(self.width * self.height)
+        self.cells[:] = self.terrain
+
+    # Return a grid using the shared memory block of another one.
+    @classmethod
+    def attach(cls, name, width, height):
+        grid         = cls.__new__(cls)
+        grid.width   = width
+        grid.height  = height
+        grid.terrain = None
+        grid.units   = None
+        grid.shm     = SharedMemory(name=name)
+        grid.cells   = grid.shm.buf
+        return grid
+
+    # Return a grid of a private copy of the cells.
+    def snapshot(self):
+        grid         = NavGrid.__new__(NavGrid)
+        grid.width   = self.width
+        grid.height  = self.height
+        grid.terrain = None
+        grid.units   = None
+        grid.shm     = None
+        grid.cells   = bytearray(self.cells)
+        return grid
+
+    # Stop sharing the grid: its cells are copied back to private memory.
+    def release(self):
+        if self.shm is None:
+            return
+        cells      = bytearray(self.cells)
+        self.cells = cells
+        self.shm.close()
+        self.shm.unlink()
+        self.shm   = None
+
+    # Return a (height, width) view of the layer, without copy. Views of the
+    # cells must not outlive a shared grid.
+    def view(self, layer="cells"):
+        return np.frombuffer(getattr(self, layer), dtype=np.uint8) \
+                 .reshape(self.height, self.width)
+
+    def index(self, u, v):
+        return v * self.width + u
+
+    def coords(self, i):
+        return (i % self.width, i // self.width)
+
+    def is_walkable(self, u, v):
+        return self.cells[v * self.width + u] == WALKABLE
+
+    # An entity now stands on the square. Return True if it was walkable.
+    def occupy(self, u, v):
+        i              = v * self.width + u
+        self.units[i] += 1
+        if self.cells[i] == WALKABLE:
+            self.cells[i] = OBSTACLE
+            return True
+        return False
+
+    # An entity left the square. Return True if it is walkable again.
+    def vacate(self, u, v):
+        i = v * self.width + u
+        assert self.units[i] >= 1
+        self.units[i] -= 1
+        if self.units[i] == 0 and self.terrain[i] == WALKABLE:
+            self.cells[i] = WALKABLE
+            return True
+        return False
+
+# Connected components of the walkable squares of a navigation grid, with the
+# diagonal moves always allowed. Two squares with different labels cannot be
+# connected. Obstacles have label 0.
+#
+# Labels are kept up to date incrementally, at a bounded cost:
+# - Freeing a square merges the components around it: their labels are joined
+#   in a union-find forest, the squares keep theirs (see `find`).
+# - Blocking a square that may split its component searches from each group of
+#   walkable squares around it at once, until they meet or all but one run out
+#   of squares: the pieces found are given new labels. The search gives up after
+#   MAX_SPLIT squares and only marks the label as dirty.
+#
+# A dirty label may hold disconnected pieces: queries on it answer that a path
+# may exist. Dirty labels are split in the background, by computing the labels
+# again on a copy of the grid, in time slices (see `relabel`).
+class Components:
+
+    NEIGHBOURS = [(0, -1), (1, -1), (1, 0), (1, 1),     # Clockwise, from the top.
+                  (0, 1), (-1, 1), (-1, 0), (-1, -1)]
+    MAX_SPLIT  = 1024   # Squares searched when blocking a square, at most.
+
+    def log(msg):
+        log_ex(msg, category="Components")
+
+    # The labels of the grid may be given, as computed for its terrain by a
+    # previous instance (see `Arena.compile`).
+    def __init__(self, grid, labels=None):
+        self.grid    = grid
+        self.journal = None     # Occupancy changes, while relabelling.
+        if labels is None:
+            self.reset()
+            complete(self.label_all())
+        else:
+            counts       = np.bincount(np.asarray(labels).ravel())
+            self.labels  = array("i", np.asarray(labels, dtype=np.int32).tobytes())
+            self.parents = list(range(len(counts)))
+            self.sizes   = {l: int(c) for (l, c) in enumerate(counts) if l != 0 and c != 0}
+            self.dirty   = set()
+        Components.log(f"count={len(self.sizes)}")
+
+    def reset(self):
+        self.labels  = array("i", [0]) * (self.grid.width * self.grid.height)
+        self.parents = [0]      # label -> label it was merged into, or itself.
+        self.sizes   = {}       # label -> squares, for the labels not merged.
+        self.dirty   = set()
+
+    def new_label(self):
+        label = len(self.parents)
+        self.parents.append(label)
+        self.sizes[label] = 0
+        return label
+
+    # Return the label the label was merged into, if any.
+    def find(self, label):
+        parents = self.parents
+        root    = label
+        while parents[root] != root:
+            root = parents[root]
+        while parents[label] != root:
+            (parents[label], label) = (root, parents[label])
+        return root
+
+    def neighbours(self, u, v):
+        (w, h) = (self.grid.width, self.grid.height)
+        for (du, dv) in Components.NEIGHBOURS:
+            (nu, nv) = (u + du, v + dv)
+            if 0 <= nu < w and 0 <= nv < h:
+                yield (nu, nv)
+
+    # Label the walkable squares from scratch, as a search yielding every
+    # `slice` squares.
+    def label_all(self, slice=None):
+        cells  = self.grid.cells
+        labels = self.labels
+        for i in range(len(labels)):
+            if cells[i] == WALKABLE and labels[i] == 0:
+                yield from self.fill(i, self.new_label(), slice)
+            elif slice is not None and i % slice == 0:
+                yield
+
+    # Give the label to the unlabelled walkable squares connected to square
+    # `i`, as a search yielding every `slice` squares.
+    def fill(self, i, label, slice=None):
+        grid      = self.grid
+        (w, h)    = (grid.width, grid.height)
+        cells     = grid.cells
+        labels    = self.labels
+        labels[i] = label
+        stack     = [i]
+        count     = 0
+        while stack:
+            j      = stack.pop()
+            count += 1
+            if slice is not None and count % slice == 0:
+                yield
+            (u, v) = (j % w, j // w)
+            for (du, dv) in Components.NEIGHBOURS:
+                nu = u + du
+                nv = v + dv
+                if nu < 0 or nu >= w or nv < 0 or nv >= h:
+                    continue
+                k = nv * w + nu
+                if labels[k] == 0 and cells[k] == WALKABLE:
+                    labels[k] = label
+                    stack.append(k)
+        self.sizes[label] += count
+
+    def label(self, u, v):
+        return self.find(self.labels[self.grid.index(u, v)])
+
+    def set_walkable(self, u, v):
+        i = self.grid.index(u, v)
+        if self.journal is not None:
+            self.journal.append((i, True))
+        if self.labels[i] != 0:
+            return
+        around = set()
+        for (nu, nv) in self.neighbours(u, v):
+            l = self.label(nu, nv)
+            if l != 0:
+                around.add(l)
+        if len(around) == 0:
+            label = self.new_label()
+        else:
+            label = max(around, key=lambda l: self.sizes[l])
+        self.labels[i]     = label
+        self.sizes[label] += 1
+
+        # Merge the other components into the largest one. The merged one is
+        # dirty if any of them was.
+        for l in around - {label}:
+            self.parents[l]    = label
+            self.sizes[label] += self.sizes.pop(l)
+            if l in self.dirty:
+                self.dirty.discard(l)
+                self.dirty.add(label)
+
+    def set_obstacle(self, u, v):
+        i = self.grid.index(u, v)
+        if self.journal is not None:
+            self.journal.append((i, False))
+        label = self.find(self.labels[i])
+        if label == 0:
+            return
+        self.labels[i]     = 0
+        self.sizes[label] -= 1
+        if self.sizes[label] == 0:
+            del self.sizes[label]
+            self.dirty.discard(label)
+            return
+        pieces = self.pieces(u, v)
+        if len(pieces) >= 2:
+            self.split(pieces, label)
+
+    # Return a walkable neighbour of the square from each group of them that
+    # is no longer connected to the others through the ring they form around
+    # it.
+    def pieces(self, u, v):
+        (w, h) = (self.grid.width, self.grid.height)
+        ring   = []
+        for (du, dv) in Components.NEIGHBOURS:
+            (nu, nv) = (u + du, v + dv)
+            ring.append(0 <= nu < w and 0 <= nv < h and self.grid.is_walkable(nu, nv))
+
+        # Walk the ring: consecutive walkable squares are connected, and so are
+        # two orthogonal neighbours around a corner (diagonal moves allowed).
+        groups = list(range(8))
+        def find(a):
+            while groups[a] != a:
+                a = groups[a]
+            return a
+        for a in range(8):
+            b = (a + 1) % 8
+            if ring[a] and ring[b]:
+                groups[find(a)] = find(b)
+            c = (a + 2) % 8
+            if a % 2 == 0 and ring[a] and ring[c]:
+                groups[find(a)] = find(c)
+        pieces = {}
+        for a in range(8):
+            if ring[a]:
+                (du, dv) = Components.NEIGHBOURS[a]
+                pieces.setdefault(find(a), self.grid.index(u + du, v + dv))
+        return list(pieces.values())
+
+    # Search from the pieces (square indexes) of the label at once, one square
+    # of each in turn. Pieces whose searches meet are connected. A piece whose
+    # search runs out of squares, while others remain, gets a new label.
+    def split(self, pieces, label):
+        grid    = self.grid
+        (w, h)  = (grid.width, grid.height)
+        cells   = grid.cells
+        owners  = {i: k for (k, i) in enumerate(pieces)}   # Square -> search.
+        queues  = [deque([i]) for i in pieces]
+        groups  = list(range(len(pieces)))                 # Searches met.
+        def find(a):
+            while groups[a] != a:
+                a = groups[a]
+            return a
+        searching = list(range(len(pieces)))
+        count     = len(pieces)                            # Groups searching.
+        while count >= 2:
+            if len(owners) > Components.MAX_SPLIT:
+                Components.log(f"label={label} dirty")
+                self.dirty.add(label)
+                return
+            is_exhausted = False
+            for k in searching:
+                queue = queues[k]
+                if not queue:
+                    continue
+                j      = queue.popleft()
+                (u, v) = (j % w, j // w)
+                for (du, dv) in Components.NEIGHBOURS:
+                    nu = u + du
+                    nv = v + dv
+                    if nu < 0 or nu >= w or nv < 0 or nv >= h:
+                        continue
+                    i = nv * w + nu
+                    if cells[i] != WALKABLE:
+                        continue
+                    owner = owners.get(i)
+                    if owner is None:
+                        owners[i] = k
+                        queue.append(i)
+                    elif find(owner) != find(k):
+                        groups[find(owner)] = find(k)
+                        count -= 1
+                if not queue:
+                    is_exhausted = True
+            if not is_exhausted or count <= 1:
+                continue
+
+            # A group of searches out of squares found a whole piece.
+            for root in {find(k) for k in searching}:
+                group = [k for k in searching if find(k) == root]
+                if count <= 1 or any(queues[k] for k in group):
+                    continue
+                piece     = [i for (i, k) in owners.items() if find(k) == root]
+                new_label = self.new_label()
+                for i in piece:
+                    self.labels[i] = new_label
+                self.sizes[new_label] += len(piece)
+                self.sizes[label]     -= len(piece)
+                searching              = [k for k in searching if find(k) != root]
+                count                 -= 1
+                Components.log(f"label={label} split, {len(piece)} squares: {new_label}")
+
+    # Compute the labels again on a copy of the grid, as a search yielding
+    # every `slice` squares. The occupancy changes made meanwhile are then
+    # replayed on the new labels, which replace the current ones.
+    def relabel(self, slice=None):
+        Components.log(f"Relabel dirty={self.dirty}")
+        fresh         = Components.__new__(Components)
+        fresh.grid    = self.grid.snapshot()
+        fresh.journal = None
+        fresh.reset()
+        self.journal  = []
+        yield from fresh.label_all(slice)
+        cells = fresh.grid.cells
+        for (i, is_walkable) in self.journal:
+            (u, v) = fresh.grid.coords(i)
+            if is_walkable:
+                cells[i] = WALKABLE
+                fresh.set_walkable(u, v)
+            else:
+                cells[i] = OBSTACLE
+                fresh.set_obstacle(u, v)
+        Components.log(f"Relabelled count={len(fresh.sizes)} changes={len(self.journal)}")
+        self.journal = None
+        self.labels  = fresh.labels
+        self.parents = fresh.parents
+        self.sizes   = fresh.sizes
+        self.dirty   = fresh.dirty
+
+    # Tell if a path may exist from the start square to the end square. The
+    # start square may itself be occupied (e.g., by the entity navigating).
+    # Both squares may be in different pieces of a dirty label.
+    def is_reachable(self, start, end):
+        (su, sv) = start
+        (eu, ev) = end
+        if max(abs(su - eu), abs(sv - ev)) <= 1:
+            return self.grid.is_walkable(eu, ev) or start == end
+        label = self.label(eu, ev)
+        if label == 0:
+            return False
+        for (nu, nv) in self.neighbours(su, sv):
+            if self.label(nu, nv) == label:
+                return True
+        return False
+
+# Landmarks for the ALT (A*, Landmarks, Triangle inequality) heuristic: the
+# cost of the shortest paths from a handful of landmark squares to every square
+# of the static terrain. By the triangle inequality, |d(L, a) - d(L, b)| is a
+# lower bound of d(a, b), and it stays one when entities add obstacles.
+#
+# Landmarks are chosen far from each other. As computing them takes a while,
+# they are stored in the compiled arena (see `ArenaFile`).
+class Landmarks:
+
+    ACTIVE = 2      # Landmarks used by a query.
+
+    def log(msg):
+        log_ex(msg, category="Landmarks")
+
+    def __init__(self, squares, distances):
+        self.squares   = squares        # Landmark square indexes.
+        self.distances = distances      # One array of costs per landmark.
+
+    # The distances may be views of a compiled arena: pickle copies.
+    def __getstate__(self):
+        return (self.squares, [array("d", bytes(d)) for d in self.distances])
+
+    def __setstate__(self, state):
+        (self.squares, self.distances) = state
+
+    # Return the landmarks stored in the compiled arena. The distances are
+    # views of the file.
+    @classmethod
+    def load(cls, compiled):
+        squares   = compiled.header["info"]["landmarks"]
+        distances = compiled.memoryview("landmarks", "d")
+        n         = len(distances) // max(len(squares), 1)
+        return cls(squares, [distances[k * n:(k + 1) * n] for k in range(len(squares))])
+
+    # Return the (info, sections) of the landmarks to store in a compiled arena.
+    def sections(self):
+        info     = {"landmarks": self.squares}
+        sections = {"landmarks": np.array(self.distances, dtype=np.float64)}
+        return (info, sections)
+
+    # Choose each landmark as the walkable square the farthest from the
+    # previous ones.
+    @classmethod
+    def compute(cls, grid, count):
+        terrain  = grid.terrain
+        walkable = [i for i in range(len(terrain)) if terrain[i] == WALKABLE]
+        if len(walkable) == 0:
+            return cls([], [])
+        squares   = []
+        distances = []
+        nearest   = cls.distances_from(grid, walkable[0])
+        for n in range(count):
+            square = max(walkable, key=lambda i: nearest[i])
+            d      = cls.distances_from(grid, square)
+            squares.append(square)
+            distances.append(d)
+            for i in walkable:
+                nearest[i] = min(nearest[i], d[i])
+            Landmarks.log(f"landmark={grid.coords(square)}")
+        return cls(squares, distances)
+
+    # Return the cost of the shortest paths over the terrain from the square
+    # (index) to every square. Unreachable squares cost infinity.
+    @classmethod
+    def distances_from(cls, grid, start):
+        (w, h)    = (grid.width, grid.height)
+        cells     = grid.terrain
+        distances = array("d", [float("inf")]) * (w * h)
+        distances[start] = 0.0
+        heap = [(0.0, start)]
+        while heap:
+            (g, i) = heappop(heap)
+            if g > distances[i]:
+                continue
+            (u, v) = (i % w, i // w)
+            for (du, dv, dc) in AStar.MOVES:
+                nu = u + du
+                nv = v + dv
+                if nu < 0 or nu >= w or nv < 0 or nv >= h:
+                    continue
+                j  = nv * w + nu
+                ng = g + dc
+                if cells[j] != WALKABLE or distances[j] <= ng:
+                    continue
+                distances[j] = ng
+                heappush(heap, (ng, j))
+        return distances
+
+    # Return the costs of the landmarks giving the best bounds from the start
+    # square to the end square. Each one is an array of costs with the cost of
+    # the end square.
+    def costs_to(self, s, e):
+        costs = [(d, d[e]) for d in self.distances
+                 if d[e] != float("inf") and d[s] != float("inf")]
+        costs.sort(key=lambda c: abs(c[1] - c[0][s]), reverse=True)
+        return costs[:Landmarks.ACTIVE]
+
+# A* over a navigation grid, with the diagonal moves always allowed.
+#
+# The per-square scratch state (cost, parent, open/closed flags) is allocated
+# once, in typed arrays: 20 bytes per square. Each query bumps a generation
+# counter and a square's scratch state is only trusted if it was stamped with
+# the current generation, so nothing has to be reset between queries.
+#
+# On grids of more than `SPARSE_SIZE` squares, the scratch state is made anew
+# for each query instead, in dictionaries of the squares it reaches: its
+# memory is bounded by the searched region, e.g. the clusters of a segment
+# (see `HPAStar`), rather than by the grid.
+class AStar:
+
+    MOVEMENT       = "diagonal"
+    MAX_GENERATION = 0xFFFFFFFF
+    SPARSE_SIZE    = 1 << 20            # Squares, beyond which the scratch state is sparse.
+    MOVES          = [(-1,  0, 1.0),     ( 1,  0, 1.0),
+                      ( 0, -1, 1.0),     ( 0,  1, 1.0),
+                      (-1, -1, sqrt(2)), ( 1, -1, sqrt(2)),
+                      (-1,  1, sqrt(2)), ( 1,  1, sqrt(2))]
+
+    def log(msg):
+        log_ex(msg, category="AStar")
+
+    def __init__(self, grid, landmarks=None):
+        n               = grid.width * grid.height
+        self.grid       = grid
+        self.landmarks  = landmarks
+        self.generation = 0
+        self.is_sparse  = n > AStar.SPARSE_SIZE
+        if self.is_sparse:
+            self.seen   = SparseScratch()
+            self.closed = SparseScratch()
+            self.cost   = {}
+            self.parent = {}
+        else:
+            self.seen   = array("I", [0]) * n  # Generation of cost/parent.
+            self.closed = array("I", [0]) * n  # Generation when expanded.
+            self.cost   = array("d", [0.0]) * n
+            self.parent = array("i", [-1]) * n
+
+        # Same moves, with the index offset.
+        w          = grid.width
+        self.moves = [(du, dv, dv * w + du, dc) for (du, dv, dc) in AStar.MOVES]
+
+    def next_generation(self):
+        if self.is_sparse:
+            self.seen   = SparseScratch()
+            self.closed = SparseScratch()
+            self.cost   = {}
+            self.parent = {}
+            return 1
+        if self.generation == AStar.MAX_GENERATION:
+            AStar.log("Generation counter wrapped, reset scratch state")
+            n               = self.grid.width * self.grid.height
+            self.seen       = array("I", [0]) * n
+            self.closed     = array("I", [0]) * n
+            self.generation = 0
+        self.generation += 1
+        return self.generation
+
+    # Octile distance.
+    def heuristic(self, u, v, eu, ev):
+        du = abs(u - eu)
+        dv = abs(v - ev)
+        if du > dv:
+            return du + (sqrt(2) - 1) * dv
+        else:
+            return dv + (sqrt(2) - 1) * du
+
+    # Return the heuristic from the start square toward the end square, as a
+    # function of a square's coordinates and index: the octile distance or, with
+    # landmarks, the best of it and the ALT lower bound.
+    def heuristic_to(self, s, eu, ev, e):
+        octile = self.heuristic
+        if self.landmarks is None:
+            return lambda u, v, i: octile(u, v, eu, ev)
+        costs = self.landmarks.costs_to(s, e)
+        def alt(u, v, i):
+            h = octile(u, v, eu, ev)
+            for (d, de) in costs:
+                di = d[i]
+                if di != float("inf") and abs(de - di) > h:
+                    h = abs(de - di)
+            return h
+        return alt
+
+    def path_to(self, i):
+        hops = []
+        while i != -1:
+            hops.append(self.grid.coords(i))
+            i = self.parent[i]
+        hops.reverse()
+        return hops
+
+    # Return the list of (u, v) hops from start to end, both included, and the
+    # number of expanded squares. The list is empty if there is no path. The
+    # search may be restricted to the (u0, v0, u1, v1) bounds, u1 and v1
+    # excluded.
+    def find_path(self, start, end, bounds=None):
+        return complete(self.search(start, end, bounds))
+
+    # Same as `find_path`, as a search yielding every `slice` expanded squares.
+    def search(self, start, end, bounds=None, slice=None):
+        (su, sv) = start
+        (eu, ev) = end
+        grid     = self.grid
+        w        = grid.width
+        if bounds is None:
+            (u0, v0, u1, v1) = (0, 0, grid.width, grid.height)
+        else:
+            (u0, v0, u1, v1) = bounds
+        cells    = grid.cells
+        gen      = self.next_generation()
+        seen     = self.seen
+        closed   = self.closed
+        cost     = self.cost
+        parent   = self.parent
+        moves    = self.moves
+
+        s         = grid.index(su, sv)
+        e         = grid.index(eu, ev)
+        heuristic = self.heuristic_to(s, eu, ev, e)
+        seen[s]   = gen
+        cost[s]   = 0.0
+        parent[s] = -1
+        heap      = [(heuristic(su, sv, s), 0.0, s)]
+        runs      = 0
+        while heap:
+            (_, g, i) = heappop(heap)
+            if closed[i] == gen:
+                continue
+            closed[i] = gen
+            runs     += 1
+            if i == e:
+                return (self.path_to(i), runs)
+            if slice is not None and runs % slice == 0:
+                yield
+            (u, v) = (i % w, i // w)
+            for (du, dv, di, dc) in moves:
+                nu = u + du
+                nv = v + dv
+                if nu < u0 or nu >= u1 or nv < v0 or nv >= v1:
+                    continue
+                j = i + di
+                if cells[j] != WALKABLE or closed[j] == gen:
+                    continue
+                ng = g + dc
+                if seen[j] == gen and cost[j] <= ng:
+                    continue
+                seen[j]   = gen
+                cost[j]   = ng
+                parent[j] = i
+                heappush(heap, (ng + heuristic(nu, nv, j), ng, j))
+        return ([], runs)
+
+    # Return the cost of the shortest paths from the start square to the
+    # target squares (indexes), within the bounds. Unreachable targets are
+    # missing from the returned dictionary.
+    def costs(self, start, targets, bounds):
+        grid             = self.grid
+        w                = grid.width
+        (u0, v0, u1, v1) = bounds
+        cells            = grid.cells
+        gen              = self.next_generation()
+        seen             = self.seen
+        closed           = self.closed
+        cost             = self.cost
+        moves            = self.moves
+
+        s        = grid.index(*start)
+        seen[s]  = gen
+        cost[s]  = 0.0
+        heap     = [(0.0, s)]
+        missing  = set(targets)
+        found    = {}
+        while heap and missing:
+            (g, i) = heappop(heap)
+            if closed[i] == gen:
+                continue
+            closed[i] = gen
+            if i in missing:
+                missing.remove(i)
+                found[i] = g
+            (u, v) = (i % w, i // w)
+            for (du, dv, di, dc) in moves:
+                nu = u + du
+                nv = v + dv
+                if nu < u0 or nu >= u1 or nv < v0 or nv >= v1:
+                    continue
+                j = i + di
+                if cells[j] != WALKABLE or closed[j] == gen:
+                    continue
+                ng = g + dc
+                if seen[j] == gen and cost[j] <= ng:
+                    continue
+                seen[j] = gen
+                cost[j] = ng
+                heappush(heap, (ng, j))
+        return found
+
+# Sparse scratch state of a search (see `AStar`): the squares it did not reach
+# read as generation 0.
+class SparseScratch(dict):
+
+    def __missing__(self, i):
+        return 0
+
+# Jump Point Search over a navigation grid, with the diagonal moves always
+# allowed. Same as A*, but the symmetric paths through open areas are skipped
+# by jumping straight or diagonally until a square with a forced neighbour is
+# met. The found path is made of jump points, expanded back into hops.
+class JumpPointSearch(AStar):
+
+    def log(msg):
+        log_ex(msg, category="JumpPointSearch")
+
+    def search(self, start, end, bounds=None, slice=None):
+        (su, sv) = start
+        (eu, ev) = end
+        grid     = self.grid
+        w        = grid.width
+        if bounds is None:
+            (u0, v0, u1, v1) = (0, 0, grid.width, grid.height)
+        else:
+            (u0, v0, u1, v1) = bounds
+        cells    = grid.cells
+        gen      = self.next_generation()
+        seen     = self.seen
+        closed   = self.closed
+        cost     = self.cost
+        parent   = self.parent
+
+        self.limits = (u0, v0, u1, v1)
+
+        def walkable(u, v):
+            return u0 <= u < u1 and v0 <= v < v1 and cells[v * w + u] == WALKABLE
+
+        s         = grid.index(su, sv)
+        e         = grid.index(eu, ev)
+        heuristic = self.heuristic_to(s, eu, ev, e)
+        seen[s]   = gen
+        cost[s]   = 0.0
+        parent[s] = -1
+        heap      = [(heuristic(su, sv, s), 0.0, s)]
+        runs      = 0
+        while heap:
+            (_, g, i) = heappop(heap)
+            if closed[i] == gen:
+                continue
+            closed[i] = gen
+            runs     += 1
+            if i == e:
+                return (self.expand(self.path_to(i)), runs)
+            if slice is not None and runs % slice == 0:
+                yield
+            (u, v) = (i % w, i // w)
+            for (nu, nv) in self.neighbours(u, v, parent[i], walkable):
+                jump = self.jump(nu, nv, nu - u, nv - v, end, walkable)
+                if jump is None:
+                    continue
+                (ju, jv) = jump
+                j        = jv * w + ju
+                if closed[j] == gen:
+                    continue
+                ng = g + self.heuristic(u, v, ju, jv)
+                if seen[j] == gen and cost[j] <= ng:
+                    continue
+                seen[j]   = gen
+                cost[j]   = ng
+                parent[j] = i
+                heappush(heap, (ng + heuristic(ju, jv, j), ng, j))
+        return ([], runs)
+
+    # Return the neighbours of the square worth jumping to, given the direction
+    # it was reached from. Some of them may be obstacles.
+    def neighbours(self, u, v, p, walkable):
+        if p == -1:
+            return [(u + du, v + dv) for (du, dv, dc) in AStar.MOVES
+                    if walkable(u + du, v + dv)]
+
+        (pu, pv) = self.grid.coords(p)
+        du       = (u > pu) - (u < pu)
+        dv       = (v > pv) - (v < pv)
+        hops     = []
+        if du != 0 and dv != 0:
+            if walkable(u, v + dv):
+                hops.append((u, v + dv))
+            if walkable(u + du, v):
+                hops.append((u + du, v))
+            hops.append((u + du, v + dv))
+            if not walkable(u - du, v):
+                hops.append((u - du, v + dv))
+            if not walkable(u, v - dv):
+                hops.append((u + du, v - dv))
+        elif du == 0:
+            hops.append((u, v + dv))
+            if not walkable(u + 1, v):
+                hops.append((u + 1, v + dv))
+            if not walkable(u - 1, v):
+                hops.append((u - 1, v + dv))
+        else:
+            hops.append((u + du, v))
+            if not walkable(u, v + 1):
+                hops.append((u + du, v + 1))
+            if not walkable(u, v - 1):
+                hops.append((u + du, v - 1))
+        return hops
+
+    # Return the jump point met going in the (du, dv) direction from the
+    # square, or None.
+    def jump(self, u, v, du, dv, end, walkable):
+        if du == 0 or dv == 0:
+            return self.jump_straight(u, v, du, dv, end, walkable)
+        while walkable(u, v):
+            if (u, v) == end:
+                return (u, v)
+            if (walkable(u - du, v + dv) and not walkable(u - du, v)) or \
+               (walkable(u + du, v - dv) and not walkable(u, v - dv)):
+                return (u, v)
+            if self.jump_straight(u + du, v, du, 0, end, walkable) is not None or \
+               self.jump_straight(u, v + dv, 0, dv, end, walkable) is not None:
+                return (u, v)
+            u += du
+            v += dv
+        return None
+
+    # Straight jumps are where the time goes: walk the cells by index rather
+    # than through walkable().
+    def jump_straight(self, u, v, du, dv, end, walkable):
+        (u0, v0, u1, v1) = self.limits
+        cells            = self.grid.cells
+        w                = self.grid.width
+        if dv == 0:
+            (a, da, a0, a1, b, b0, b1, step, side) = (u, du, u0, u1, v, v0, v1, du, w)
+        else:
+            (a, da, a0, a1, b, b0, b1, step, side) = (v, dv, v0, v1, u, u0, u1, dv * w, 1)
+        if not (b0 <= b < b1):
+            return None
+        i     = v * w + u
+        e     = end[1] * w + end[0]
+        left  = b + 1 < b1
+        right = b - 1 >= b0
+        last  = a1 - 1 if da > 0 else a0
+        while a0 <= a < a1 and cells[i] == WALKABLE:
+            if i == e:
+                break
+            if a != last:
+                n = i + step
+                if left and cells[n + side] == WALKABLE and cells[i + side] != WALKABLE:
+                    break
+                if right and cells[n - side] == WALKABLE and cells[i - side] != WALKABLE:
+                    break
+            a += da
+            i += step
+        else:
+            return None
+        return (i % w, i // w)
+
+    # Turn a list of jump points into a list of hops. Consecutive jump points
+    # are always on a same straight or diagonal line.
+    def expand(self, jump_points):
+        if jump_points == []:
+            return []
+        hops = [jump_points[0]]
+        for (ju, jv) in jump_points[1:]:
+            (u, v) = hops[-1]
+            du     = (ju > u) - (ju < u)
+            dv     = (jv > v) - (jv < v)
+            while (u, v) != (ju, jv):
+                u += du
+                v += dv
+                hops.append((u, v))
+        return hops
+
+# Hierarchical path finding (HPA*).
+#
+# The arena is split into square clusters. Entrances are the walkable runs
+# along the border between two adjacent clusters, each one represented by one
+# or two transitions, i.e., pairs of facing squares. As diagonal moves are
+# always allowed, a diagonal move across a border or a corner of clusters is a
+# transition too, when no entrance leads to both of its squares. The abstract
+# graph links the transitions of a same cluster (with the cost of the shortest
+# path inside the cluster) and the two squares of each transition (with the
+# cost of the move).
+#
+# A long path is found on the abstract graph as a list of waypoints, then
+# refined into hops one segment at a time, as the entity walks (see `NavPath`).
+#
+# Everything is computed lazily: borders and intra-cluster edges are only built
+# when the abstract search reaches them, and only the clusters touched by an
+# occupancy change are invalidated.
+class HPAStar:
+
+    CLUSTER_SIZE   = 16     # squares
+    MAX_ENTRANCE   = 6      # Longer entrances get a transition at each end.
+
+    def log(msg):
+        log_ex(msg, category="HPAStar")
+
+    def __init__(self, grid, finder):
+        size         = HPAStar.CLUSTER_SIZE
+        self.grid    = grid
+        self.finder  = finder
+        self.cwidth  = (grid.width  + size - 1) // size
+        self.cheight = (grid.height + size - 1) // size
+        self.borders  = {}      # (cu, cv, "e"|"s"|"c") -> [(i, j, cost), …]
+        self.edges    = {}      # (cu, cv) -> {i: [(j, cost), …]}
+        self.building = set()   # Clusters whose edges are being built, still valid.
+        HPAStar.log(f"clusters={self.cwidth}x{self.cheight} size={size}")
+
+    def cluster_of(self, u, v):
+        return (u // HPAStar.CLUSTER_SIZE, v // HPAStar.CLUSTER_SIZE)
+
+    def bounds(self, cluster):
+        (cu, cv) = cluster
+        size     = HPAStar.CLUSTER_SIZE
+        return (cu * size, cv * size,
+                min(self.grid.width,  (cu + 1) * size),
+                min(self.grid.height, (cv + 1) * size))
+
+    # Return the bounds of the box around the clusters of two squares.
+    def window(self, start, end):
+        (a0, b0, a1, b1) = self.bounds(self.cluster_of(*start))
+        (c0, d0, c1, d1) = self.bounds(self.cluster_of(*end))
+        return (min(a0, c0), min(b0, d0), max(a1, c1), max(b1, d1))
+
+    # Tell if the path between two squares is long enough to be worth an
+    # abstract search.
+    def is_long(self, start, end):
+        (su, sv) = start
+        (eu, ev) = end
+        return max(abs(su - eu), abs(sv - ev)) > 2 * HPAStar.CLUSTER_SIZE
+
+    # Forget about what depends on the occupancy of the square.
+    def invalidate(self, u, v):
+        (cu, cv)         = cluster = self.cluster_of(u, v)
+        (u0, v0, u1, v1) = self.bounds(cluster)
+        self.drop_edges(cluster)
+        touched = []
+        if u == u0 and cu >= 1:
+            touched.append((cu - 1, cv, "e"))
+        if u == u1 - 1:
+            touched.append((cu, cv, "e"))
+        if v == v0 and cv >= 1:
+            touched.append((cu, cv - 1, "s"))
+        if v == v1 - 1:
+            touched.append((cu, cv, "s"))
+        size = HPAStar.CLUSTER_SIZE
+        for ku in {u // size, (u + 1) // size}:
+            for kv in {v // size, (v + 1) // size}:
+                if ku * size in (u, u + 1) and kv * size in (v, v + 1):
+                    touched.append((ku, kv, "c"))
+        for key in touched:
+            if self.borders.pop(key, None) is not None:
+                (bu, bv, side) = key
+                if side == "e":
+                    self.drop_edges((bu, bv))
+                    self.drop_edges((bu + 1, bv))
+                elif side == "s":
+                    self.drop_edges((bu, bv))
+                    self.drop_edges((bu, bv + 1))
+                else:
+                    for cluster in [(bu - 1, bv - 1), (bu, bv - 1), (bu - 1, bv), (bu, bv)]:
+                        self.drop_edges(cluster)
+
+    def drop_edges(self, cluster):
+        self.edges.pop(cluster, None)
+        self.building.discard(cluster)
+
+    # Return the (i, j, cost) transitions of the border on the east ("e") or
+    # south ("s") side of the cluster, or of its north-west corner ("c").
+    def border(self, key):
+        if key in self.borders:
+            return self.borders[key]
+
+        (cu, cv, side)   = key
+        (u0, v0, u1, v1) = self.bounds((cu, cv))
+        grid             = self.grid
+        transitions      = []
+        if side == "e" and 0 <= cu < self.cwidth - 1 and 0 <= cv < self.cheight:
+            facing = [((u1 - 1, v), (u1, v)) for v in range(v0, v1)]
+        elif side == "s" and 0 <= cv < self.cheight - 1 and 0 <= cu < self.cwidth:
+            facing = [((u, v1 - 1), (u, v1)) for u in range(u0, u1)]
+        else:
+            facing = []
+        if side == "c" and 1 <= cu < self.cwidth and 1 <= cv < self.cheight:
+            transitions = self.crossings([((u0 - 1, v0 - 1), (u0, v0)),
+                                          ((u0, v0 - 1), (u0 - 1, v0))])
+
+        run = []
+        for pair in facing + [None]:
+            if pair is not None and all(grid.is_walkable(*square) for square in pair):
+                run.append((grid.index(*pair[0]), grid.index(*pair[1]), 1.0))
+                continue
+            if len(run) >= HPAStar.MAX_ENTRANCE:
+                transitions.append(run[0])
+                transitions.append(run[-1])
+            elif len(run) >= 1:
+                transitions.append(run[len(run) // 2])
+            run = []
+
+        # Diagonal moves across the border, but not across a corner.
+        for (k, (a, b)) in enumerate(facing):
+            for dk in (-1, 1):
+                if 0 <= k + dk < len(facing):
+                    transitions += self.crossings([(a, facing[k + dk][1])])
+        self.borders[key] = transitions
+        return transitions
+
+    # Return the (i, j, cost) transitions of the diagonal moves between the
+    # (u, v) pairs of squares that no straight moves lead around.
+    def crossings(self, pairs):
+        grid        = self.grid
+        transitions = []
+        for ((au, av), (bu, bv)) in pairs:
+            if grid.is_walkable(au, av) and grid.is_walkable(bu, bv) \
+               and not grid.is_walkable(au, bv) and not grid.is_walkable(bu, av):
+                transitions.append((grid.index(au, av), grid.index(bu, bv), sqrt(2)))
+        return transitions
+
+    # Return the abstract edges of the cluster, as a dictionary mapping each of
+    # its transition squares to its neighbours.
+    def cluster_edges(self, cluster):
+        return complete(self.build_edges(cluster))
+
+    # Same as `cluster_edges`, as a search yielding after the search from each
+    # transition when sliced. The edges are only kept if the cluster was not
+    # invalidated meanwhile.
+    def build_edges(self, cluster, slice=None):
+        if cluster in self.edges:
+            return self.edges[cluster]
+
+        self.building.add(cluster)
+        (cu, cv) = cluster
+        edges    = {}
+        def link(i, j, cost):
+            edges.setdefault(i, []).append((j, cost))
+        keys = [(cu, cv, "e"), (cu, cv, "s"), (cu - 1, cv, "e"), (cu, cv - 1, "s"),
+                (cu, cv, "c"), (cu + 1, cv, "c"), (cu, cv + 1, "c"), (cu + 1, cv + 1, "c")]
+        for key in keys:
+            for (i, j, cost) in self.border(key):
+                if self.cluster_of(*self.grid.coords(i)) == cluster:
+                    link(i, j, cost)
+                elif self.cluster_of(*self.grid.coords(j)) == cluster:
+                    link(j, i, cost)
+
+        nodes  = list(edges.keys())
+        bounds = self.bounds(cluster)
+        for a in range(len(nodes)):
+            if slice is not None and a >= 1:
+                yield
+            i     = nodes[a]
+            costs = self.finder.costs(self.grid.coords(i), nodes[a + 1:], bounds)
+            for (j, cost) in costs.items():
+                link(i, j, cost)
+                link(j, i, cost)
+        if cluster in self.building:
+            self.building.discard(cluster)
+            self.edges[cluster] = edges
+        return edges
+
+    # Return the costs from the square to the transitions of its cluster, of
+    # the edges given.
+    def connect(self, square, edges):
+        cluster = self.cluster_of(*square)
+        return self.finder.costs(square, list(edges.keys()), self.bounds(cluster))
+
+    # Return the list of (u, v) waypoints from start to end, both included.
+    # Two consecutive waypoints belong to the same cluster or face each other
+    # across a border. The list is empty if no abstract path was found.
+    def find_path(self, start, end):
+        return complete(self.search(start, end))
+
+    # Same as `find_path`, as a search yielding every `slice` expanded nodes,
+    # and before and while building the edges of a cluster.
+    def search(self, start, end, slice=None):
+        grid = self.grid
+        s    = grid.index(*start)
+        e    = grid.index(*end)
+
+        def edges_of(cluster):
+            if slice is not None and cluster not in self.edges:
+                yield
+            return (yield from self.build_edges(cluster, slice))
+
+        edges       = yield from edges_of(self.cluster_of(*start))
+        start_edges = self.connect(start, edges)
+        edges       = yield from edges_of(self.cluster_of(*end))
+        goal_edges  = self.connect(end, edges)
+        if self.cluster_of(*start) == self.cluster_of(*end):
+            start_edges.update(self.finder.costs(start, [e],
+                                                 self.bounds(self.cluster_of(*start))))
+
+        (eu, ev) = end
+        h        = self.finder.heuristic
+        cost     = {s: 0.0}
+        parent   = {s: None}
+        closed   = set()
+        heap     = [(h(*start, eu, ev), 0.0, s)]
+        runs     = 0
+        while heap:
+            (_, g, i) = heappop(heap)
+            if i in closed:
+                continue
+            closed.add(i)
+            runs += 1
+            if i == e:
+                waypoints = []
+                while i is not None:
+                    waypoints.append(grid.coords(i))
+                    i = parent[i]
+                waypoints.reverse()
+                HPAStar.log(f"waypoints={len(waypoints)} runs={runs}")
+                return waypoints
+            if slice is not None and runs % slice == 0:
+                yield
+            cluster = self.cluster_of(*grid.coords(i))
+            edges   = yield from edges_of(cluster)
+            if i == s:
+                neighbours = list(start_edges.items()) + edges.get(i, [])
+            else:
+                neighbours = edges.get(i, [])
+                if i in goal_edges:
+                    neighbours = neighbours + [(e, goal_edges[i])]
+            for (j, dc) in neighbours:
+                ng = g + dc
+                if j in closed or cost.get(j, ng + 1) <= ng:
+                    continue
+                cost[j]   = ng
+                parent[j] = i
+                heappush(heap, (ng + h(*grid.coords(j), eu, ev), ng, j))
+        HPAStar.log(f"No abstract path runs={runs}")
+        return []
+
+# A flow field leads a group of entities to a same goal square. It holds the
+# cost of the shortest path from each square to the goal, computed once by a
+# Dijkstra search from the goal, and each entity reads its next hop from it.
+#
+# The search is bounded to the box around the members and the goal, grown by
+# one cluster. It reads the terrain only: units, members or not, are avoided
+# locally, when reading the next hop. Units moving do not invalidate the field,
+# only its eviction from the compass does (see `Compass.build_flow_field`).
+class FlowField:
+
+    MARGIN   = 16   # squares
+    SIDESTEP = 1.5  # Slack of a step aside (see `next_hop`).
+
+    def log(msg):
+        log_ex(msg, category="FlowField")
+
+    def __init__(self, grid, goal, members, starts):
+        (gu, gv)      = goal
+        self.grid     = grid
+        self.goal     = goal
+        self.members  = set(members)
+        self.is_valid = True
+
+        us = [u for (u, v) in starts] + [gu]
+        vs = [v for (u, v) in starts] + [gv]
+        m  = FlowField.MARGIN
+        self.bounds = (max(0, min(us) - m), max(0, min(vs) - m),
+                       min(grid.width,  max(us) + m + 1),
+                       min(grid.height, max(vs) + m + 1))
+        (u0, v0, u1, v1) = self.bounds
+        self.width       = u1 - u0
+        self.costs       = array("d", [float("inf")]) * (self.width * (v1 - v0))
+        self.is_complete = False
+
+    def contains(self, u, v):
+        (u0, v0, u1, v1) = self.bounds
+        return u0 <= u < u1 and v0 <= v < v1
+
+    def cost(self, u, v):
+        (u0, v0, u1, v1) = self.bounds
+        return self.costs[(v - v0) * self.width + (u - u0)]
+
+    # Compute the costs, as a search yielding every `slice` expanded squares.
+    def integrate(self, slice=None):
+        (u0, v0, u1, v1) = self.bounds
+        (w, terrain)     = (self.width, self.grid.terrain)
+        gw               = self.grid.width
+        costs            = self.costs
+        (gu, gv)         = self.goal
+
+        costs[(gv - v0) * w + (gu - u0)] = 0.0
+        heap = [(0.0, gu, gv)]
+        runs = 0
+        while heap:
+            (g, u, v) = heappop(heap)
+            if g > costs[(v - v0) * w + (u - u0)]:
+                continue
+            runs += 1
+            if slice is not None and runs % slice == 0:
+                yield
+            for (du, dv, dc) in AStar.MOVES:
+                nu = u + du
+                nv = v + dv
+                if nu < u0 or nu >= u1 or nv < v0 or nv >= v1:
+                    continue
+                if terrain[nv * gw + nu] != WALKABLE:
+                    continue
+                ng = g + dc
+                j  = (nv - v0) * w + (nu - u0)
+                if costs[j] <= ng:
+                    continue
+                costs[j] = ng
+                heappush(heap, (ng, nu, nv))
+        self.is_complete = True
+        FlowField.log(f"goal={self.goal} bounds={self.bounds} runs={runs}")
+
+    # Tell if the goal can be reached from the square through the field.
+    def reaches(self, u, v):
+        return self.contains(u, v) and self.cost(u, v) != float("inf")
+
+    # Return the (u, v) neighbours leading toward the goal, walkable or not.
+    def downhill(self, u, v):
+        cost = self.cost(u, v)
+        return [(u + du, v + dv) for (du, dv, dc) in AStar.MOVES
+                if self.contains(u + du, v + dv) and self.cost(u + du, v + dv) < cost]
+
+    # Return the (u, v) neighbour leading toward the goal with the lowest
+    # cost, among the walkable ones. Return None if all of them are occupied.
+    # With some slack, neighbours up to that much further from the goal are
+    # also considered: the entity steps aside.
+    def next_hop(self, u, v, slack=0.0):
+        cost = self.cost(u, v) + slack
+        best = None
+        for (du, dv, dc) in AStar.MOVES:
+            (nu, nv) = (u + du, v + dv)
+            if not self.contains(nu, nv) or not self.grid.is_walkable(nu, nv):
+                continue
+            ncost = self.cost(nu, nv)
+            if ncost >= cost:
+                continue
+            if best is None or ncost + dc < best[0]:
+                best = (ncost + dc, nu, nv)
+        if best is None:
+            return None
+        return (best[1], best[2])
+
+# Incremental planner (D* Lite) from a moving start square to a fixed goal
+# square, with the diagonal moves always allowed.
+#
+# The search runs backward, from the goal. The planner is told about every
+# occupancy change (see `touch`) and only the squares whose cost to the goal is
+# affected are expanded again on the next `replan`, instead of redoing the
+# whole search.
+#
+# Costs are integers, so that the keys of a square computed at different times
+# compare exactly: with floats, the key modifier summed over replans drifts.
+class DStarLite:
+
+    INFINITY = float("inf")
+    STRAIGHT = 1000000                      # Cost of a straight move.
+    DIAGONAL = 1414214                      # Cost of a diagonal move, sqrt(2) times.
+    MOVES    = [(-1,  0, STRAIGHT),     ( 1,  0, STRAIGHT),
+                ( 0, -1, STRAIGHT),     ( 0,  1, STRAIGHT),
+                (-1, -1, DIAGONAL),     ( 1, -1, DIAGONAL),
+                (-1,  1, DIAGONAL),     ( 1,  1, DIAGONAL)]
+
+    def log(msg):
+        log_ex(msg, category="DStarLite")
+
+    def __init__(self, grid, start, goal):
+        self.grid  = grid
+        self.start = grid.index(*start)
+        self.goal  = grid.index(*goal)
+        self.km    = 0
+        self.g     = {}
+        self.rhs   = {self.goal: 0}
+        self.keys  = {}                 # Current key of the queued squares.
+        self.heap  = []
+        (u, v)     = goal
+        self.box   = [u, v, u, v]       # Bounds of the explored squares.
+        self.push(self.goal)
+
+    def heuristic(self, i, j):
+        w  = self.grid.width
+        du = abs(i % w - j % w)
+        dv = abs(i // w - j // w)
+        return DStarLite.STRAIGHT * max(du, dv) \
+            + (DStarLite.DIAGONAL - DStarLite.STRAIGHT) * min(du, dv)
+
+    def key(self, i):
+        m = min(self.g.get(i, DStarLite.INFINITY), self.rhs.get(i, DStarLite.INFINITY))
+        return (m + self.heuristic(self.start, i) + self.km, m)
+
+    def push(self, i):
+        k            = self.key(i)
+        self.keys[i] = k
+        heappush(self.heap, (k, i))
+
+    # Return the lowest (key, square) queued, dropping the outdated entries.
+    def top(self):
+        while self.heap:
+            (k, i) = self.heap[0]
+            if self.keys.get(i) == k:
+                return (k, i)
+            heappop(self.heap)
+        return (None, None)
+
+    def neighbours(self, i):
+        (w, h) = (self.grid.width, self.grid.height)
+        (u, v) = (i % w, i // w)
+        for (du, dv, dc) in DStarLite.MOVES:
+            (nu, nv) = (u + du, v + dv)
+            if 0 <= nu < w and 0 <= nv < h:
+                yield (nv * w + nu, dc)
+
+    def update_vertex(self, i):
+        if i not in self.rhs:
+            self.explore(i)
+        if i != self.goal:
+            cells = self.grid.cells
+            rhs   = DStarLite.INFINITY
+            for (j, dc) in self.neighbours(i):
+                if cells[j] == WALKABLE:
+                    rhs = min(rhs, dc + self.g.get(j, DStarLite.INFINITY))
+            self.rhs[i] = rhs
+        self.keys.pop(i, None)
+        if self.g.get(i, DStarLite.INFINITY) != self.rhs.get(i, DStarLite.INFINITY):
+            self.push(i)
+
+    # Expand the inconsistent squares, as a search yielding every `slice`
+    # expanded squares. The planner may be touched while the search waits.
+    def compute(self, slice=None):
+        runs = 0
+        s    = self.start
+        while True:
+            if slice is not None and runs >= 1 and runs % slice == 0:
+                yield
+            (k, i) = self.top()
+            if k is None:
+                break
+            is_consistent = self.rhs.get(s, DStarLite.INFINITY) == self.g.get(s, DStarLite.INFINITY)
+            if k >= self.key(s) and is_consistent:
+                break
+            heappop(self.heap)
+            del self.keys[i]
+            runs += 1
+            if k < self.key(i):
+                self.push(i)
+            elif self.g.get(i, DStarLite.INFINITY) > self.rhs[i]:
+                self.g[i] = self.rhs[i]
+                for (j, dc) in self.neighbours(i):
+                    self.update_vertex(j)
+            else:
+                self.g[i] = DStarLite.INFINITY
+                self.update_vertex(i)
+                for (j, dc) in self.neighbours(i):
+                    self.update_vertex(j)
+        DStarLite.log(f"runs={runs}")
+
+    # The square is explored: extend the bounds.
+    def explore(self, i):
+        w      = self.grid.width
+        (u, v) = (i % w, i // w)
+        box    = self.box
+        if u < box[0]:
+            box[0] = u
+        elif u > box[2]:
+            box[2] = u
+        if v < box[1]:
+            box[1] = v
+        elif v > box[3]:
+            box[3] = v
+
+    # Tell if a change of occupancy of the square may touch the explored
+    # squares: the square is next to their bounds.
+    def covers(self, u, v):
+        box = self.box
+        return box[0] - 1 <= u <= box[2] + 1 and box[1] - 1 <= v <= box[3] + 1
+
+    # The occupancy of the square changed: update the squares leading to it, if
+    # already explored.
+    def touch(self, u, v):
+        for (j, dc) in self.neighbours(self.grid.index(u, v)):
+            if j in self.rhs:
+                self.update_vertex(j)
+
+    # Return the list of (u, v) hops from the start square to the goal, the
+    # start excluded. The list is empty if there is no path.
+    def replan(self, start):
+        return complete(self.search(start))
+
+    # Same as `replan`, as a search yielding every `slice` expanded squares.
+    def search(self, start, slice=None):
+        s           = self.grid.index(*start)
+        self.km    += self.heuristic(self.start, s)
+        self.start  = s
+        yield from self.compute(slice)
+
+        cells = self.grid.cells
+        hops  = []
+        i     = s
+        while i != self.goal:
+            (best_cost, best) = (DStarLite.INFINITY, None)
+            for (j, dc) in self.neighbours(i):
+                if cells[j] != WALKABLE:
+                    continue
+                cost = dc + self.g.get(j, DStarLite.INFINITY)
+                if cost < best_cost:
+                    (best_cost, best) = (cost, j)
+            if best is None or len(hops) > len(cells):
+                return []
+            i = best
+            hops.append(self.grid.coords(i))
+        return hops
+
+# A LRU cache of the paths found by the compass, keyed by (start, goal,
+# movement). A cached path is the list of (u, v) hops of its first segment and
+# its remaining (u, v) waypoints (see `HPAStar`).
+#
+# The arena is split into regions, the HPA* clusters. Each path records the
+# regions it crosses, and is dropped as soon as the occupancy of one of them
+# changes, unless the change was made by an entity following that very path
+# (see `NavPath.cached`).
+class PathCache:
+
+    def log(msg):
+        log_ex(msg, category="PathCache")
+
+    def __init__(self, capacity, hpa):
+        self.capacity      = capacity
+        self.hpa           = hpa
+        self.paths         = OrderedDict()  # key -> CachedPath
+        self.regions       = {}             # region -> {key, …}
+        self.hits          = 0
+        self.misses        = 0
+        self.evictions     = 0
+        self.invalidations = 0
+
+    def __str__(self):
+        return f"size={len(self.paths)}/{self.capacity} hits={self.hits} " \
+            f"misses={self.misses} evictions={self.evictions} " \
+            f"invalidations={self.invalidations}"
+
+    # Return the cached path, or None.
+    def get(self, key):
+        path = self.paths.get(key)
+        if path is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.paths.move_to_end(key)
+        PathCache.log(f"hit {key}: {self}")
+        return path
+
+    def put(self, key, hops, waypoints):
+        if self.capacity <= 0:
+            return
+        if key in self.paths:
+            self.drop(key)
+        path = CachedPath(hops, waypoints)
+        for (u, v) in hops + waypoints:
+            path.regions.add(self.hpa.cluster_of(u, v))
+        self.paths[key] = path
+        for region in path.regions:
+            self.regions.setdefault(region, set()).add(key)
+        if len(self.paths) > self.capacity:
+            self.drop(next(iter(self.paths)))
+            self.evictions += 1
+
+    def drop(self, key):
+        path = self.paths.pop(key)
+        for region in path.regions:
+            keys = self.regions[region]
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.regions[region]
+
+    # The occupancy of the square was changed by an entity following the path
+    # of the key, if any.
+    def touch(self, u, v, key=None):
+        region = self.hpa.cluster_of(u, v)
+        for other in list(self.regions.get(region, ())):
+            if other == key:
+                continue
+            self.drop(other)
+            self.invalidations += 1
+
+class CachedPath:
+
+    def __init__(self, hops, waypoints):
+        self.hops      = hops
+        self.waypoints = waypoints
+        self.regions   = set()
+
+# Path finding in a worker process of the compass pool. Each worker attaches to
+# the shared navigation grid once, then runs A* on it.
+remote_finder = None
+
+def remote_init(name, width, height, landmarks, finder):
+    global remote_finder
+    remote_finder = Compass.FINDERS[finder](NavGrid.attach(name, width, height),
+                                            landmarks)
+
+def remote_find_path(start, end):
+    return remote_finder.find_path(start, end)
 
 # A compass help find a navigation path through an arena, avoiding obstacles.
 class Compass:
 
+    SLICE   = 64    # Squares expanded by a queued request between budget checks.
+    FINDERS = {"astar": AStar, "jps": JumpPointSearch}
+
     _singleton = None
 
     @classmethod
@@ -25,122 +1523,680 @@ class Compass:
     def log(msg):
         log_ex(msg, category="Compass")
 
-    def __init__(self, obstacles_matrix):
+    # With workers, navigation requests are planned by a pool of processes
+    # sharing the navigation grid.
+    #
+    # With landmarks of the terrain, A* uses them (see `Landmarks`). With the
+    # component labels of the terrain, they are not computed again (see
+    # `Components`).
+    #
+    # With smoothing, entities walk straight runs of hops in one move (see
+    # `NavPath.next_hop`).
+    #
+    # At most `fields_size` flow fields are kept (see `flow_field`).
+    def __init__(self, terrain, workers=0, cache_size=256, fields_size=16,
+                 landmarks=None, labels=None, finder="astar", smoothing=False):
         assert Compass._singleton is None
         Compass._singleton = self
-        self.grid          = Grid(matrix=obstacles_matrix)
+        self.grid          = NavGrid(terrain, shared=workers >= 1)
+        self.components    = Components(self.grid, labels)
+        self.landmarks     = landmarks
+        if finder not in Compass.FINDERS:
+            raise RuntimeError(f"Invalid finder: {finder}")
+        self.finder        = Compass.FINDERS[finder](self.grid, self.landmarks)
+        self.hpa           = HPAStar(self.grid, self.finder)
+        self.paths         = PathCache(cache_size, self.hpa)
+        self.flow_fields   = OrderedDict()  # (u, v, entities) -> FlowField
+        self.fields_size   = fields_size
+        self.planners      = set()
+        self.sliced_finder = Compass.FINDERS[finder](self.grid, self.landmarks)   # Only for the queued requests.
+        self.requests      = deque()
+        self.replans       = deque()        # Requests of entities on their way.
+        self.remote        = []
+        self.relabelling   = None           # See `Components.relabel`.
+        self.smoothing     = smoothing
+        if workers >= 1:
+            self.pool = ProcessPoolExecutor(max_workers=workers,
+                                            initializer=remote_init,
+                                            initargs=(self.grid.shm.name,
+                                                      self.grid.width,
+                                                      self.grid.height,
+                                                      self.landmarks,
+                                                      finder))
+        else:
+            self.pool = None
+        Compass.log(f"Finder: {self.finder.__class__} workers={workers}")
+
+    def quit(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        self.grid.release()
+
+    # The entity now stands on the square.
+    def occupy(self, square, entity):
+        if self.grid.occupy(square.u, square.v):
+            self.components.set_obstacle(square.u, square.v)
+            self.touch_occupancy(square, entity)
+
+    # The entity left the square.
+    def vacate(self, square, entity):
+        if self.grid.vacate(square.u, square.v):
+            self.components.set_walkable(square.u, square.v)
+            self.touch_occupancy(square, entity)
+
+    # The entity moved from the old square to the new one.
+    def move(self, entity, old_square, new_square):
+        self.vacate(old_square, entity)
+        self.occupy(new_square, entity)
 
-        from pathfinding.finder.a_star import AStarFinder
-        self.finder = AStarFinder(diagonal_movement=DiagonalMovement.always,
-                                  time_limit=0.5)
-        Compass.log(f"Finder: {self.finder.__class__}")
+    def touch_occupancy(self, square, entity):
+        self.hpa.invalidate(square.u, square.v)
+        self.paths.touch(square.u, square.v, entity.nav_path.cached)
+        for planner in self.planners:
+            if planner.covers(square.u, square.v):
+                planner.touch(square.u, square.v)
 
-    def set_walkable(self, square):
-        self.grid.node(square.u, square.v).walkable = True
+    # Return an incremental planner from the start square to the goal square.
+    # It is kept up to date until released.
+    def planner(self, start, goal):
+        planner = DStarLite(self.grid, (start.u, start.v), (goal.u, goal.v))
+        self.planners.add(planner)
+        return planner
 
-    def set_obstacle(self, square):
-        self.grid.node(square.u, square.v).walkable = False
+    def release_planner(self, planner):
+        self.planners.discard(planner)
 
     def is_obstacle(self, square):
-        return self.grid.node(square.u, square.v).walkable == False
+        return not self.grid.is_walkable(square.u, square.v)
 
-    def navigate(self, entity, square):
+    # Return the walkable neighbour of the square the closest to the other
+    # square and reachable from it, or None.
+    def free_neighbour(self, square, from_square):
+        start = (from_square.u, from_square.v)
+        best  = None
+        for (du, dv, dc) in AStar.MOVES:
+            (u, v) = (square.u + du, square.v + dv)
+            if not (0 <= u < self.grid.width and 0 <= v < self.grid.height):
+                continue
+            if (u, v) != start and not self.components.is_reachable(start, (u, v)):
+                continue
+            cost = self.finder.heuristic(u, v, *start)
+            if best is None or cost < best[0]:
+                best = (cost, u, v)
+        if best is None:
+            return None
+        return self.squarify((best[1], best[2]))
+
+    def squarify(self, hop):
+        (u, v) = hop
+        from .arena import Square
+        return Square(u, v)
+
+    # Return the square at the index of the grid.
+    def unpack(self, i):
+        return self.squarify(self.grid.coords(i))
+
+    # Turn the (u, v) hops into packed hops: an array of grid indexes.
+    def pack(self, hops):
+        return array("l", [self.grid.index(u, v) for (u, v) in hops])
+
+    # Turn the (u, v) hops found by a search from the square into packed hops,
+    # the square itself excluded.
+    def hopify(self, from_square, hops, runs):
+        Compass.log(f"steps={len(hops)} runs={runs} hops={hops}")
+        if hops == []:
+            return array("l")
+
+        # Remove the entity's current position.
+        (u, v) = hops[0]
+        assert (u, v) == (from_square.u, from_square.v)
+
+        for (nu, nv) in hops[1:]:
+            assert max(abs(nu - u), abs(nv - v)) == 1
+            (u, v) = (nu, nv)
+        return self.pack(hops[1:])
+
+    # Return the square the entity is on, or about to be.
+    def entity_square(self, entity):
         if entity.is_moving():
-            entity_square = entity.target_position().square()
+            return entity.target_position().square()
         else:
-            entity_square = entity.position().square()
+            return entity.position().square()
+
+    def navigate(self, entity, square):
+        return complete(self.plan(entity, square, self.finder))
+
+    # Plan the navigation of the entity to the square, as a search yielding
+    # every `slice` expanded squares. Return True if a path was found.
+    def plan(self, entity, square, finder, slice=None):
+        # A sliced search does nothing before its first slice: the checks
+        # below run in the budget of the update advancing it.
+        if slice is not None:
+            yield
+        entity_square = self.entity_square(entity)
         Compass.log(f"Navigate {entity.name} from {entity_square} to {square}")
 
-        Compass.log(f"Cleanup grid…")
-        self.grid.cleanup()
-        Compass.log(f"Grid clean")
+        start = (entity_square.u, entity_square.v)
+        end   = (square.u, square.v)
+        if not self.components.is_reachable(start, end):
+            Compass.log(f"Unreachable")
+            entity.stop()
+            return False
+
+        key    = (start, end, finder.MOVEMENT)
+        cached = self.paths.get(key)
+        if cached is not None:
+            return self.apply(entity, entity_square, list(cached.hops), 0,
+                              list(cached.waypoints), key)
 
-        start = self.grid.node(entity_square.u, entity_square.v)
-        end   = self.grid.node(square.u, square.v)
+        # Long paths are found on the abstract graph, only the first segment
+        # is refined now. The next ones will be as the entity walks the path.
+        waypoints = []
+        if self.hpa.is_long(start, end):
+            Compass.log(f"Finding abstract path…")
+            waypoints = yield from self.hpa.search(start, end, slice=slice)
+            if waypoints != []:
+                waypoints.pop(0)
+                end = waypoints.pop(0)
 
         Compass.log(f"Finding path…")
-        try:
-            (hops, runs) = self.finder.find_path(start, end, self.grid)
-        except ExecutionTimeException:
+        (hops, runs) = yield from finder.search(start, end, slice=slice)
+        if hops != []:
+            self.paths.put(key, list(hops), list(waypoints))
+        return self.apply(entity, entity_square, hops, runs, waypoints, key)
+
+    # Make the entity navigate along the (u, v) hops found from its square,
+    # cached under the key. Return True if a path was found.
+    def apply(self, entity, entity_square, hops, runs, waypoints=None, key=None):
+        hops = self.hopify(entity_square, hops, runs)
+        if len(hops) == 0:
             Compass.log(f"No path found")
             entity.stop()
             return False
         else:
             Compass.log(f"Path found")
 
-        Compass.log(f"steps={len(hops)} runs={runs} hops={hops}")
+        entity.navigate(hops, [self.squarify(w) for w in waypoints or []])
+        entity.nav_path.cached = key
+        return True
 
-        def squarify(hop):
-            (u, v) = hop
-            from .arena import Square
-            return Square(u, v)
+    # Return the flow field leading the entities to the square. Fields are
+    # cached as long as one of their members follows them. Past `fields_size`
+    # fields, the least recently used ones are invalidated.
+    def flow_field(self, entities, square):
+        return complete(self.build_flow_field(entities, square))
 
-        if hops != []:
-            # Remove the entity's current position.
-            firstHop = squarify( hops.pop(0) )
-            assert firstHop == entity_square
+    # Same as `flow_field`, as a search yielding every `slice` expanded
+    # squares.
+    def build_flow_field(self, entities, square, slice=None):
+        key   = (square.u, square.v, frozenset(entities))
+        field = self.flow_fields.get(key)
+        if field is None or not field.is_complete:
+            starts                = [(s.u, s.v) for s in map(self.entity_square, entities)]
+            field                 = FlowField(self.grid, (square.u, square.v),
+                                              entities, starts)
+            self.flow_fields[key] = field
+            while len(self.flow_fields) > self.fields_size:
+                (_, evicted)     = self.flow_fields.popitem(last=False)
+                evicted.is_valid = False
+            yield from field.integrate(slice)
+        else:
+            self.flow_fields.move_to_end(key)
+        return field
+
+    # Forget about the complete fields none of their members follows.
+    def drop_flow_fields(self):
+        for (key, field) in list(self.flow_fields.items()):
+            if field.is_complete \
+               and not any(e.nav_path.field is field for e in field.members):
+                del self.flow_fields[key]
+
+    # Navigate a group of entities to the square, following a shared flow
+    # field. Entities the field does not reach navigate on their own (queued
+    # as requests of their own when sliced).
+    def navigate_group(self, entities, square):
+        complete(self.plan_group(set(entities), square))
+
+    # Plan the navigation of a group of entities, as a search yielding every
+    # `slice` expanded squares. Entities removed from the set meanwhile are
+    # left alone.
+    def plan_group(self, entities, square, slice=None):
+        Compass.log(f"Navigate {len(entities)} entities to {square}")
+        field = yield from self.build_flow_field(list(entities), square, slice)
+        for entity in list(entities):
+            entity_square = self.entity_square(entity)
+            if entity_square == square:
+                entity.stop()
+                continue
+            if field.reaches(entity_square.u, entity_square.v):
+                entity.follow(field)
+            elif slice is None:
+                self.navigate(entity, square)
+            else:
+                search = self.plan(entity, square, self.sliced_finder, slice)
+                self.requests.append(NavRequest({entity}, search))
+        self.drop_flow_fields()
 
+    def cancel(self, entity):
+        for queue in (self.replans, self.requests):
+            for request in list(queue):
+                request.entities.discard(entity)
+                if len(request.entities) == 0:
+                    queue.remove(request)
+        for request in list(self.remote):
+            request.entities.discard(entity)
+            if len(request.entities) == 0:
+                request.search.cancel()
+                self.remote.remove(request)
+
+    # Queue the navigation of the entity to the square. The entity stops after
+    # its current hop and stays idle until its plan completes (see `update`).
+    # Return the request, or None if it was served at once.
+    def request(self, entity, square):
+        self.cancel(entity)
+        entity.stop()
+        if self.pool is not None:
+            return self.request_remote(entity, square)
+        search  = self.plan(entity, square, self.sliced_finder, Compass.SLICE)
+        request = NavRequest({entity}, search)
+        self.requests.append(request)
+        return request
+
+    # Queue the refinement of the segment of the entity's path leading from the
+    # square to the waypoint, the remaining waypoints following. Return the
+    # request.
+    #
+    # Replans are served before the new orders (see `update`). A segment lies
+    # in the clusters of its ends: its search is bounded to them and runs in a
+    # single step, with the finder of the synchronous searches.
+    def request_segment(self, entity, square, waypoint, waypoints):
+        request = NavRequest({entity}, self.plan_segment(entity, square, waypoint, waypoints))
+        self.replans.append(request)
+        return request
+
+    def plan_segment(self, entity, square, waypoint, waypoints):
+        yield
+        Compass.log(f"Refine {entity.name} from {square} to {waypoint}")
+        start = (square.u, square.v)
+        end   = (waypoint.u, waypoint.v)
+        hops  = []
+        if self.components.is_reachable(start, end):
+            bounds       = self.hpa.window(start, end)
+            (hops, runs) = self.finder.find_path(start, end, bounds)
         if hops == []:
-            Compass.log("Invalid path")
+            Compass.log(f"No path to waypoint {waypoint}")
+            entity.nav_path.renavigate(waypoints[-1] if waypoints else waypoint)
             return False
-
-        previous_hop = entity_square
-        for h in range(len(hops)):
-            current_hop  = squarify(hops[h])
-            assert current_hop.is_next_to(previous_hop)
-            hops[h]      = current_hop
-            previous_hop = current_hop
-        entity.navigate(hops)
+        key = entity.nav_path.cached
+        self.apply(entity, square, hops, runs, [(w.u, w.v) for w in waypoints], key)
         return True
 
+    # Queue the repair of the entity's path from the square with the
+    # incremental planner (see `NavPath.repair`). Return the request.
+    def request_repair(self, entity, square, planner):
+        search  = self.plan_repair(entity, square, planner, Compass.SLICE)
+        request = NavRequest({entity}, search)
+        self.replans.append(request)
+        return request
+
+    def plan_repair(self, entity, square, planner, slice=None):
+        hops = yield from planner.search((square.u, square.v), slice)
+        entity.nav_path.repaired(square, hops)
+
+    # Same as `request`, planned by the pool. The search of the request is the
+    # future of the path.
+    def request_remote(self, entity, square):
+        entity_square = self.entity_square(entity)
+        Compass.log(f"Navigate {entity.name} from {entity_square} to {square} (remote)")
+        start = (entity_square.u, entity_square.v)
+        end   = (square.u, square.v)
+        if not self.components.is_reachable(start, end):
+            Compass.log(f"Unreachable")
+            return None
+        key    = (start, end, AStar.MOVEMENT)
+        cached = self.paths.get(key)
+        if cached is not None:
+            self.apply(entity, entity_square, list(cached.hops), 0,
+                       list(cached.waypoints), key)
+            return None
+        future        = self.pool.submit(remote_find_path, start, end)
+        request       = NavRequest({entity}, future)
+        request.start = entity_square
+        request.key   = key
+        self.remote.append(request)
+        return request
+
+    # Apply the paths found by the pool.
+    def update_remote(self):
+        for request in [r for r in self.remote if r.search.done()]:
+            self.remote.remove(request)
+            (hops, runs) = request.search.result()
+            if hops != []:
+                self.paths.put(request.key, list(hops), [])
+            for entity in request.entities:
+                self.apply(entity, request.start, list(hops), runs, None, request.key)
+
+    # Same as `request`, for a group of entities sharing a flow field. Return
+    # the request.
+    def request_group(self, entities, square):
+        for entity in entities:
+            self.cancel(entity)
+            entity.stop()
+        members = set(entities)
+        search  = self.plan_group(members, square, Compass.SLICE)
+        request = NavRequest(members, search)
+        self.requests.append(request)
+        return request
+
+    # Advance the queued requests, in order, for about `budget` microseconds
+    # (at least one slice of each queue): the replans first, then the new
+    # orders. Return the number of requests still queued and the microseconds
+    # used. What is left of the budget relabels the dirty components, if any.
+    #
+    # A request may be cancelled while advanced, as its entities get new
+    # orders: it is then already out of the queue.
+    def update(self, budget):
+        if len(self.replans) == 0 and len(self.requests) == 0 \
+           and len(self.remote) == 0 and len(self.components.dirty) == 0:
+            return (0, 0)
+        start    = perf_counter()
+        self.update_remote()
+        deadline = start + budget / 1000000
+        for queue in (self.replans, self.requests):
+            while queue:
+                request = queue[0]
+                try:
+                    next(request.search)
+                except StopIteration:
+                    if queue and queue[0] is request:
+                        queue.popleft()
+                if perf_counter() >= deadline:
+                    break
+        while len(self.components.dirty) >= 1 and perf_counter() < deadline:
+            if self.relabelling is None:
+                self.relabelling = self.components.relabel(Compass.SLICE)
+            try:
+                next(self.relabelling)
+            except StopIteration:
+                self.relabelling = None
+        used = int((perf_counter() - start) * 1000000)
+        return (len(self.replans) + len(self.requests) + len(self.remote), used)
+
+# A navigation request waiting in the compass queue: the entities it concerns
+# and the search planning their navigation (or its future, when planned by the
+# pool).
+class NavRequest:
+
+    def __init__(self, entities, search):
+        self.entities = entities
+        self.search   = search
+        self.start    = None
+        self.key      = None
+
 # A navigation path is a list of hops. A hop is a square directly connected to
 # the previous one.
+#
+# A long navigation path is made of segments leading to successive waypoints
+# (see `HPAStar`). Only the current segment is made of hops, the next one is
+# refined when the last hop of the current one is reached.
+#
+# When following a flow field (see `FlowField`), there's no list of hops: each
+# hop is read from the field once the previous one is reached.
 class NavPath:
 
+    MAX_WAITS = 60      # Hops to wait for a free square before giving up.
+    MAX_RUN   = 8       # Hops merged in one move when smoothing.
+
+    # The hops are packed (see `Compass.pack`): only the current hop is a
+    # square. The cursor is the index of the next hop.
     def __init__(self, entity):
-        self.entity = entity
-        self.hop    = None
-        self.hops   = []
+        self.entity    = entity
+        self.hop       = None
+        self.hops      = array("l")
+        self.cursor    = 0
+        self.run       = 1
+        self.waypoints = []
+        self.field     = None
+        self.waits     = 0
+        self.closest   = float("inf")  # Lowest field cost reached.
+        self.planner   = None
+        self.cached    = None   # Key of the cached path followed, if any (see `PathCache`).
+        self.job       = None   # Compass request the path waits for, if any.
         self.show()
 
     def log(self, msg):
         log_ex(msg, name=self.entity.name, category="NavPath")
 
     def clear(self):
-        self.hop  = None
-        self.hops = []
+        self.hop       = None
+        self.hops      = array("l")
+        self.cursor    = 0
+        self.run       = 1
+        self.waypoints = []
+        self.field     = None
+        self.waits     = 0
+        self.closest   = float("inf")
+        self.cached    = None
+        self.release_planner()
+        if self.job is not None:
+            self.job = None
+            Compass.singleton().cancel(self.entity)
+
+    # Wait on the square for the compass request to complete: it sets the
+    # path again, or clears it.
+    def wait(self, job):
+        self.hop = Compass.singleton().entity_square(self.entity)
+        self.job = job
+
+    def is_waiting(self):
+        return self.job is not None
 
-    def set(self, hops):
+    def release_planner(self):
+        if self.planner is not None:
+            Compass.singleton().release_planner(self.planner)
+            self.planner = None
+
+    # Number of hops left after the current one.
+    def remaining(self):
+        return len(self.hops) - self.cursor
+
+    # Repair the path to the end of the current segment around the blocked
+    # next hop, with an incremental planner kept across repairs. The repair is
+    # queued (see `repaired`). Return False if there is no path.
+    def repair(self):
+        c     = Compass.singleton()
+        start = c.entity_square(self.entity)
+        goal  = self.hops[-1]
+        if not c.components.is_reachable((start.u, start.v), c.grid.coords(goal)):
+            return False
+        if self.planner is None or self.planner.goal != goal:
+            self.release_planner()
+            self.planner = c.planner(start, c.unpack(goal))
+        self.wait(c.request_repair(self.entity, start, self.planner))
+        return True
+
+    # The repair from the square found the (u, v) hops: the next hop is the
+    # first of them.
+    def repaired(self, square, hops):
+        c        = Compass.singleton()
+        self.job = None
+        if hops == []:
+            self.renavigate(self.destination())
+            return
+        self.log(f"Repaired {len(hops)} hops to {c.unpack(self.hops[-1])}")
+        self.hop    = square
+        self.hops   = c.pack(hops)
+        self.cursor = 0
+
+    def set(self, hops, waypoints=None):
         assert len(hops) >= 1
-        self.hop  = hops[0]
-        self.hops = hops[1:]
+        self.clear()
+        self.hops      = hops
+        self.waypoints = [] if waypoints is None else waypoints
+        self.advance()
         self.show()
 
+    def follow(self, field):
+        self.clear()
+        self.field = field
+        self.hop   = Compass.singleton().entity_square(self.entity)
+        self.next_field_hop()
+        self.show()
+
+    def next_field_hop(self):
+        c = Compass.singleton()
+        if not self.field.is_valid:
+            self.log(f"Flow field invalidated")
+            followers = [e for e in self.field.members if e.nav_path.field is self.field]
+            job       = c.request_group(followers, self.destination())
+            for entity in followers:
+                entity.nav_path.wait(job)
+            return
+
+        square = c.entity_square(self.entity)
+        if (square.u, square.v) == self.field.goal:
+            self.log(f"Done")
+            self.clear()
+            return
+
+        # The waits only start over once the entity gets closer to the goal
+        # than it ever was: stepping aside and back does not.
+        hop = self.field.next_hop(square.u, square.v)
+        if hop is not None:
+            self.hop = c.squarify(hop)
+            if self.field.cost(*hop) < self.closest:
+                self.closest = self.field.cost(*hop)
+                self.waits   = 0
+        elif self.waits >= 1 and self.is_walled_in(square):
+            self.log(f"Units at rest toward {self.field.goal}, stop here")
+            self.clear()
+        elif self.waits < NavPath.MAX_WAITS:
+            # Units are in the way: wait, and step aside every other time.
+            if self.waits % 2 == 1:
+                hop = self.field.next_hop(square.u, square.v, FlowField.SIDESTEP)
+            if hop is not None:
+                self.log(f"No free square toward {self.field.goal}, step aside")
+                self.hop = c.squarify(hop)
+            else:
+                self.log(f"No free square toward {self.field.goal}, wait")
+                self.hop = square
+            self.waits += 1
+        else:
+            self.log(f"No free square toward {self.field.goal} for too long")
+            self.renavigate(self.destination())
+
+    # Tell if the squares leading toward the goal of the field from the square
+    # are all taken by entities done with their own path: the entity is as
+    # close as it gets, in the crowd gathered at the goal. Only asked after a
+    # first wait, as the members of a group start one after the other.
+    def is_walled_in(self, square):
+        from .arena import Arena
+        entities = Arena.singleton().entities
+        for (u, v) in self.field.downhill(square.u, square.v):
+            others = entities.at(u, v)
+            if len(others) == 0 \
+               or any(not (e.nav_path.is_done() and e.is_idle()) for e in others):
+                return False
+        return True
+
+    # Refine the segment leading to the next waypoint. Occupied waypoints are
+    # skipped, an occupied destination is replaced by its free neighbour the
+    # closest to the entity. The refinement is queued: the entity waits for
+    # it, or stops. The planner of the segment left is released.
+    def refine(self):
+        self.release_planner()
+
+        c        = Compass.singleton()
+        waypoint = self.waypoints.pop(0)
+        while c.is_obstacle(waypoint) and len(self.waypoints) >= 1:
+            self.log(f"Obstacle at waypoint {waypoint}, skip it")
+            waypoint = self.waypoints.pop(0)
+        if c.is_obstacle(waypoint):
+            waypoint = c.free_neighbour(waypoint, self.hop)
+            if waypoint is None or waypoint == self.hop:
+                self.log(f"Obstacle at destination, stop here")
+                self.clear()
+                return
+            self.log(f"Obstacle at destination, go to {waypoint}")
+        self.log(f"Refine to waypoint {waypoint}")
+        self.wait(c.request_segment(self.entity, self.hop, waypoint, self.waypoints))
+
+    # Navigate again to the destination, or next to it if it is occupied. The
+    # navigation is queued: the entity waits for it, its planner released.
+    def renavigate(self, destination):
+        self.log(f"Renavigate")
+        self.release_planner()
+        c      = Compass.singleton()
+        square = c.entity_square(self.entity)
+        if c.is_obstacle(destination):
+            destination = c.free_neighbour(destination, square)
+            if destination is None or destination == square:
+                self.log(f"Obstacle at destination, stop here")
+                self.entity.stop()
+                return
+        job = c.request(self.entity, destination)
+        if job is not None:
+            self.wait(job)
+
+    # Move the cursor to the next hop. When smoothing, the hops following it
+    # in the same direction are merged into it as long as they are free:
+    # the entity then walks the whole run in one move.
+    def advance(self):
+        c        = Compass.singleton()
+        hops     = self.hops
+        i        = hops[self.cursor]
+        self.run = 1
+        if c.smoothing and self.hop is not None:
+            cells = c.grid.cells
+            step  = i - c.grid.index(self.hop.u, self.hop.v)
+            while self.run < NavPath.MAX_RUN and self.cursor + 1 < len(hops) \
+                  and hops[self.cursor + 1] - i == step \
+                  and cells[i] == WALKABLE and cells[i + step] == WALKABLE:
+                self.cursor += 1
+                self.run    += 1
+                i           += step
+        self.cursor += 1
+        self.hop     = c.unpack(i)
+
     def next_hop(self):
-        if len(self.hops) >= 1:
-            self.hop  = self.hops[0]
-            self.hops = self.hops[1:]
+        if self.field is not None:
+            self.next_field_hop()
+            return
+        if self.remaining() == 0 and len(self.waypoints) >= 1:
+            self.refine()
+            return
+        if self.remaining() >= 1:
+            self.advance()
 
+            # The end of a segment is a waypoint: the entity goes on to the
+            # next one from where it stands.
             c = Compass.singleton()
             if c.is_obstacle(self.hop):
-                if len(self.hops) == 0:
+                if self.remaining() == 0 and len(self.waypoints) == 0:
                     self.log(f"Obstacle at destination {self.hop}")
                     self.log(f"Stop here")
-                    self.hop  = None
-                    self.hops = []
+                    self.clear()
+                elif self.remaining() == 0:
+                    self.log(f"Obstacle at waypoint {self.hop}")
+                    self.hop = c.entity_square(self.entity)
+                    self.refine()
                 else:
                     self.log(f"Obstacle at next hop {self.hop}")
-                    self.log(f"Renavigate")
-                    c.navigate(self.entity, self.destination())
+                    if not self.repair():
+                        self.renavigate(self.destination())
         else:
             self.log(f"Done")
-            self.hop  = None
-            self.hops = []
+            self.clear()
 
     def destination(self):
         assert not self.is_done()
-        if len(self.hops) >= 1:
-            return self.hops[-1]
+        if self.field is not None:
+            return Compass.singleton().squarify(self.field.goal)
+        elif len(self.waypoints) >= 1:
+            return self.waypoints[-1]
+        elif self.remaining() >= 1:
+            return Compass.singleton().unpack(self.hops[-1])
         elif self.hop is not None:
             return self.hop
 
@@ -148,44 +2204,55 @@ class NavPath:
         return self.hop is None
 
     def show(self):
-        hops = "[" + ", ".join([str(h) for h in self.hops]) + "]"
-        self.log(f"hop={self.hop} hops={hops}")
+        if len(self.hops) >= 1:
+            grid = Compass.singleton().grid
+            hops = [grid.coords(i) for i in self.hops[self.cursor:]]
+        else:
+            hops = []
+        hops      = "[" + ", ".join([f"[{u}, {v}]" for (u, v) in hops]) + "]"
+        waypoints = "[" + ", ".join([str(w) for w in self.waypoints]) + "]"
+        self.log(f"hop={self.hop} hops={hops} waypoints={waypoints}")
 
     def blit_next_hop(self, surface, hop):
         if not hop.is_visible():
-            return
+            return None
         p = hop.point().screen()
 
-        pygame.draw.rect(surface, (0, 0, 200),
-                         Rect((p.x-2, p.y-2), (4, 4)))
+        return pygame.draw.rect(surface, (0, 0, 200),
+                                Rect((p.x-2, p.y-2), (4, 4)))
 
     def blit_hop(self, surface, hop):
         if not hop.is_visible():
-            return
+            return None
         p = hop.point().screen()
 
-        pygame.draw.rect(surface, (0, 0, 200),
-                         Rect((p.x-1, p.y-1), (2, 2)))
+        return pygame.draw.rect(surface, (0, 0, 200),
+                                Rect((p.x-1, p.y-1), (2, 2)))
 
     def blit_last_hop(self, surface, hop):
         if not hop.is_visible():
-            return
+            return None
         p = hop.point().screen()
 
-        pygame.draw.rect(surface, (0, 0, 200),
-                         Rect((p.x-2, p.y-2), (4, 4)))
+        return pygame.draw.rect(surface, (0, 0, 200),
+                                Rect((p.x-2, p.y-2), (4, 4)))
 
+    # Return the rectangles of the markers drawn.
     def blit(self, surface):
         if self.is_done():
-            return
-        if len(self.hops) >= 1:
-            self.blit_next_hop(surface, self.hop)
-            for hop in self.hops[0:-1]:
-                self.blit_hop(surface, hop)
-            hop = self.hops[-1]
-            self.blit_last_hop(surface, hop)
+            return []
+        rects = []
+        if self.remaining() >= 1:
+            c = Compass.singleton()
+            rects.append(self.blit_next_hop(surface, self.hop))
+            for i in self.hops[self.cursor:-1]:
+                rects.append(self.blit_hop(surface, c.unpack(i)))
+            rects.append(self.blit_last_hop(surface, c.unpack(self.hops[-1])))
         else:
-            self.blit_last_hop(surface, self.hop)
+            rects.append(self.blit_last_hop(surface, self.hop))
+        for waypoint in self.waypoints:
+            rects.append(self.blit_last_hop(surface, waypoint))
+        return [rect for rect in rects if rect is not None]
 
 # A navigation beacon is a square in the arena that is not an obstacle.
 class NavBeacon:
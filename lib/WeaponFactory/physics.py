@@ -1,9 +1,10 @@
 # Units:
-#    Speed: frames per seconds
+#    Speed: ticks per seconds (see `Engine.run`)
 
 from .arena import Point
 from .core  import Engine
 from .math  import Vector
+from .text  import Text
 from .utils import Config, log_ex
 
 class Physics:
@@ -26,14 +27,17 @@ class Physics:
     def position(self):
         return self.translation.current
 
+    def interpolate(self, alpha):
+        return self.translation.interpolate(alpha)
+
     def target_position(self):
         return self.translation.target
 
     def look_at(self, point):
         self.rotation.look(self.position(), point)
 
-    def move_to(self, point):
-        self.translation.move_to(point)
+    def move_to(self, point, hops=1):
+        self.translation.move_to(point, hops)
 
     def is_done(self):
         return self.rotation.is_done() and self.translation.is_done()
@@ -42,17 +46,18 @@ class Physics:
         self.rotation.update()
         self.translation.update()
 
+    # Blit the position, orientation and vector next to the (x, y) screen
+    # coordinates, and return the rectangles drawn on.
     def blit_at(self, surface, x, y):
-        if False:
-            x += 20
-            y += 8
-            # FIXME
-            # pyxel.text(x, y, f"P: {self.position()}", 0)
-            raise NotImplementedError("Must replace pyxel.text")
-            y += 8
-            # pyxel.text(x, y, f"O: {self.orientation()}°", 0)
-            y += 8
-            # pyxel.text(x, y, f"V: {self.translation.vector}", 0)
+        t     = Text.singleton()
+        x    += 20
+        y    += 8
+        rects = [t.blit(surface, f"P: {self.position()}", x, y)]
+        y    += 8
+        rects.append(t.blit(surface, f"O: {self.orientation()}°", x, y))
+        y    += 8
+        rects.append(t.blit(surface, f"V: {self.translation.vector}", x, y))
+        return rects
 
 class Rotation:
 
@@ -64,8 +69,8 @@ class Rotation:
         self.target      = None                        # Degrees
         self.direction   = None                        # 1: left, -1: right
         self.step        = step                        # Rotation steps in degrees.
-        self.frame_ratio = Engine.singleton().fps / fps
-        Rotation.log(f"frame_ratio={self.frame_ratio}")
+        self.tick_ratio  = Engine.singleton().tick_rate / fps
+        Rotation.log(f"tick_ratio={self.tick_ratio}")
 
     def show(self):
         Rotation.log(f"current={self.current} step={self.step}")
@@ -102,7 +107,7 @@ class Rotation:
     def update(self):
         if self.is_done():
             return
-        if Engine.singleton().frame_count % self.frame_ratio != 0:
+        if Engine.singleton().tick_count % self.tick_ratio != 0:
             return
         self.rotate()
         if self.current == self.target:
@@ -168,12 +173,13 @@ class Translation:
 
     def __init__(self, current, fps):
         self.current     = current
+        self.previous    = (current.x, current.y)  # At the previous tick.
         self.target      = None
         self.distance    = None
         self.vector      = None
         self.vector_len  = None
-        self.frame_ratio = Engine.singleton().fps / fps
-        Translation.log(f"frame_ratio={self.frame_ratio}")
+        self.tick_ratio  = Engine.singleton().tick_rate / fps
+        Translation.log(f"tick_ratio={self.tick_ratio}")
 
     def show(self):
         Translation.log(f"current={self.current}")
@@ -203,7 +209,9 @@ class Translation:
         self.current.y += self.vector.y
         self.distance  -= self.vector_len
 
-    def move_to(self, point):
+    # The point is the given number of hops away, each walked at the same
+    # speed.
+    def move_to(self, point, hops=1):
         assert isinstance(point, Point)
         Translation.log("move_to")
         self.target = point
@@ -212,17 +220,27 @@ class Translation:
         Translation.log(f"move_to: v={v}")
         self.distance = v.get_length()
         if self.distance >= 1:
-            self.vector    = v.get_unit().scale(self.distance // self.frame_ratio)
+            self.vector    = v.get_unit().scale((self.distance / hops) // self.tick_ratio)
             self.vector_len = self.vector.get_length()
             assert self.vector_len <= self.distance
         else:
             self.stop()
         self.show()
 
+    # Return the (x, y) position between the previous tick and the current one,
+    # alpha being the fraction of the tick elapsed since the current one.
+    def interpolate(self, alpha):
+        if alpha >= 1:
+            return (self.current.x, self.current.y)
+        (px, py) = self.previous
+        return (px + (self.current.x - px) * alpha,
+                py + (self.current.y - py) * alpha)
+
     def update(self):
+        self.previous = (self.current.x, self.current.y)
         if self.is_done():
             return
-        if Engine.singleton().frame_count % self.frame_ratio != 0:
+        if Engine.singleton().tick_count % self.tick_ratio != 0:
             return
         self.translate()
         if self.distance is None or self.distance <= 0:
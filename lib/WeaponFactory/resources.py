@@ -9,8 +9,13 @@ from pprint  import pprint
 
 from .utils import Config, log_ex
 
+# Images are loaded as is. Sprite sheets are drawn from an atlas instead: all
+# the images of the sprites found in the sprite directories, packed in a
+# single surface converted to the display format (see `atlas`).
 class Resources:
 
+    ALIGNMENT = 16      # Pixels. Sheets start at a multiple of it in the atlas.
+
     _singleton = None
 
     @classmethod
@@ -36,24 +41,34 @@ class Resources:
         return pjoin(home_dir, ".local", "share", "wf")
 
     @classmethod
-    def locate(cls, resource_type, file_name):
+    def _dirs(cls, resource_type):
         rt_dirs = Config.singleton().get("resources.json", resource_type)
         if rt_dirs is None:
             raise RuntimeError(f"Invalid resource type: {resource_type}")
-        for d in rt_dirs:
-            if d[0] == "/":
-                path = os.path.join(d, file_name)
-            else:
-                path = pjoin(Resources._dir(), d, file_name)
+        return [d if d[0] == "/" else pjoin(Resources._dir(), d) for d in rt_dirs]
+
+    # Return the path of the resource, or None if missing.
+    @classmethod
+    def find(cls, resource_type, file_name):
+        for d in Resources._dirs(resource_type):
+            path = os.path.join(d, file_name)
             if os.path.exists(path):
                 return path
-        else:
+        return None
+
+    @classmethod
+    def locate(cls, resource_type, file_name):
+        path = Resources.find(resource_type, file_name)
+        if path is None:
+            rt_dirs = Config.singleton().get("resources.json", resource_type)
             Resources.log(f'Resources Base Directory: {Resources._dir()}')
             Resources.log(f'{resource_type} Directories: {rt_dirs}')
             raise RuntimeError(f"Missing {resource_type} resource: {file_name}")
+        return path
 
     def __init__(self):
-        self.images = {}
+        self.images  = {}
+        self.atlases = {}   # Display format -> (atlas, origins)
 
     def image(self, name):
         if name in self.images:
@@ -67,3 +82,45 @@ class Resources:
         self.images[name] = img
         Resources.log(f'Image: name="{name}" path="{path}" img={img}')
         return img
+
+    # Return the (sheet, (x, y)) of the sprite sheet image: the atlas holding
+    # it and its origin there.
+    def sheet(self, name):
+        (atlas, origins) = self.atlas()
+        return (atlas, origins[name])
+
+    # Return the (atlas, origins) of the sprite sheets for the current display
+    # format, packed on first use.
+    def atlas(self):
+        display = pygame.display.get_surface()
+        assert display is not None, "The atlas needs the display"
+        key     = (display.get_bitsize(), display.get_masks())
+        if key not in self.atlases:
+            self.atlases[key] = self.pack()
+        return self.atlases[key]
+
+    # Pack the images of the sprites one below the other, their color key
+    # turned into alpha.
+    def pack(self):
+        names = set()
+        for d in Resources._dirs("sprite"):
+            for file_name in os.listdir(d):
+                if file_name.endswith(".json"):
+                    with open(os.path.join(d, file_name), "r") as cf:
+                        names.add(json.loads(cf.read())["image"])
+
+        origins = {}
+        (w, h)  = (0, 0)
+        for name in sorted(names):
+            (iw, ih)      = self.image(name).get_size()
+            origins[name] = (0, h)
+            w             = max(w, iw)
+            h            += -(-ih // Resources.ALIGNMENT) * Resources.ALIGNMENT
+
+        atlas = pygame.Surface((w, h), pygame.SRCALPHA)
+        atlas.fill((0, 0, 0, 0))
+        for (name, origin) in origins.items():
+            atlas.blit(self.image(name), origin)
+        atlas = atlas.convert_alpha()
+        Resources.log(f"Atlas: size={w}x{h} sheets={len(origins)} format={atlas}")
+        return (atlas, origins)
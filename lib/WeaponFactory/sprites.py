@@ -7,12 +7,16 @@ from .arena      import Arena
 from .navigation import Compass, NavPath
 from .physics    import Physics
 from .resources  import Resources
+from .text       import Text
 from .utils      import Config, Observable, log_ex
 
 # A sprite is something that is animated.
 #
 # A sprite's coordinates are expressed in pixels (via its `point` property, of
 # type Point). There's no direct relationship between a sprite and a square.
+#
+# The blit methods return the rectangles of the surface they drew on (see
+# `Engine.draw`).
 class Sprite:
 
     def __init__(self, name, orig_point, width, height):
@@ -39,21 +43,27 @@ class Sprite:
     def is_visible(self):
         return self.position().is_visible()
 
-    def blit_debug_overlay(self, surface):
+    # The sprite is at the (x, y) screen coordinates.
+    def blit_debug_overlay(self, surface, x, y):
         if not Config.singleton().must_log("Sprite"):
-            return
-        if False:
-            # FIXME
-            # pyxel.text(p.x + 5, p.y, self.name, 0)
-            raise NotImplementedError("Must replace pyxel.text")
+            return []
+        return [surface.blit(Text.singleton().render(self.name), (x + 5, y))]
+
+    # Return the blit of the current frame at the screen coordinates and zoom
+    # level (see `Engine._blit_scene`), or None.
+    def frame_at(self, x, y, zoom=0):
+        return self.animation.frame_at(x, y, zoom)
 
     def blit(self, surface):
         if not self.is_visible():
-            return
+            return []
 
-        p = self.position().screen()
-        self.animation.blit_at(surface, p.x, p.y)
+        p    = self.position().screen()
+        rect = self.animation.blit_at(surface, p.x, p.y)
         # self.blit_debug_overlay(surface)
+        if rect is None:
+            return []
+        return [rect]
 
 # An entity is a sprite that somehow obey the laws of physics.
 #
@@ -75,9 +85,11 @@ class Entity(Sprite, Observable):
 
     def select(self):
         self.is_selected = True
+        self.notify_observers("entity-selected")
 
     def unselect(self):
         self.is_selected = False
+        self.notify_observers("entity-unselected")
 
     def show(self):
         Entity.log(self, f"moves={len(self.moves)} nav_path={self.nav_path.is_done()}")
@@ -94,6 +106,9 @@ class Entity(Sprite, Observable):
     def position(self):
         return self.physics.position()
 
+    def interpolate(self, alpha):
+        return self.physics.interpolate(alpha)
+
     def target_position(self):
         return self.physics.target_position()
 
@@ -115,13 +130,15 @@ class Entity(Sprite, Observable):
             self.physics.look_at(hop.point())
         self.add_move(look_at_hop)
 
-    def move_to(self, hop):
+    # The hop may be a run of hops (see `NavPath.advance`), walked at the
+    # speed of a single one.
+    def move_to(self, hop, run=1):
         def move_to_hop():
             p = hop.point()
             if Compass.singleton().is_obstacle(hop):
                 Entity.log(self, f"move_to_hop: Cannot move, obstacle at target hop {hop}")
             else:
-                self.physics.move_to(p)
+                self.physics.move_to(p, run)
                 self.notify_observers("entity-moved",
                                       old_square=self.square(), new_square=hop)
         self.add_move(move_to_hop)
@@ -134,27 +151,39 @@ class Entity(Sprite, Observable):
         self.clear_moves()
         self.nav_path.clear()
 
-    def navigate(self, hops):
+    def navigate(self, hops, waypoints=None):
         assert len(hops) >= 1
         Entity.log(self, "navigate")
         self.clear_moves()
-        self.nav_path.set(hops)
+        self.nav_path.set(hops, waypoints)
         self.look_at(self.nav_path.hop)
-        self.move_to(self.nav_path.hop)
+        self.move_to(self.nav_path.hop, self.nav_path.run)
         self.show()
 
+    def follow(self, field):
+        Entity.log(self, "follow")
+        self.clear_moves()
+        self.nav_path.follow(field)
+        if not self.nav_path.is_done():
+            self.look_at(self.nav_path.hop)
+            self.move_to(self.nav_path.hop)
+        self.show()
+
+    # No move while the navigation path waits for the compass.
     def next_hop(self):
-        if self.nav_path.is_done():
+        if self.nav_path.is_done() or self.nav_path.is_waiting():
             return
 
         self.nav_path.next_hop()
         if self.nav_path.is_done():
             Entity.log(self, f"next_hop: Destination {self.square()} reached")
+        elif self.nav_path.is_waiting():
+            Entity.log(self, f"next_hop: Waiting for the compass")
         else:
             nh = self.nav_path.hop
             Entity.log(self, f"next_hop: Moving to hop {nh}")
             self.look_at(nh)
-            self.move_to(nh)
+            self.move_to(nh, self.nav_path.run)
 
     def next_move(self):
         if not self.physics.is_done():
@@ -171,26 +200,30 @@ class Entity(Sprite, Observable):
         self.next_move()
         Sprite.update(self)
 
-    def blit_selection(self, surface):
+    # The entity is at the (x, y) screen coordinates, at the zoom level.
+    def blit_selection(self, surface, x, y, zoom=0):
         if not self.is_selected:
-            return
+            return []
 
-        p  = self.position().screen()
         bw = 1
-        w  = self.width  + bw + bw
-        h  = self.height + bw + bw
-        pygame.draw.rect(surface, (200, 0, 0),
-                         Rect((p.x - w // 2, p.y - h // 2), (w, h)),
-                         width=bw)
+        w  = (self.width  >> zoom) + bw + bw
+        h  = (self.height >> zoom) + bw + bw
+        return [pygame.draw.rect(surface, (200, 0, 0),
+                                 Rect((x - w // 2, y - h // 2), (w, h)),
+                                 width=bw)]
 
     def blit_nav_path(self, surface):
         if Config.singleton().must_log("NavPath"):
-            self.nav_path.blit(surface)
+            return self.nav_path.blit(surface)
+        return []
 
-    def blit_overlay(self, surface):
+    # The entity is at the (x, y) screen coordinates.
+    def blit_overlay(self, surface, x, y):
+        rects  = self.blit_debug_overlay(surface, x, y)
+        rects += self.animation.blit_overlay(surface, x, y)
         if Config.singleton().must_log("Physics"):
-            p = self.position().screen()
-            self.physics.blit_at(surface, p.x, p.y)
+            rects += self.physics.blit_at(surface, x, y)
+        return rects
 
     def blit(self, surface):
-        Sprite.blit(self, surface)
+        return Sprite.blit(self, surface)
@@ -0,0 +1,58 @@
+import pygame
+
+from collections import OrderedDict
+
+from .utils import log_ex
+
+# Text is drawn from caches: fonts, the default font of pygame, are created
+# once per size, and rendered strings are kept in a LRU cache, so that text
+# that does not change from a frame to the next (labels, names, the position
+# of an idle entity) costs a single blit.
+class Text:
+
+    SIZE        = 10    # Pixels. Default font size, the one of debug overlays.
+    MAX_STRINGS = 1024  # Rendered strings kept in cache.
+
+    _singleton = None
+
+    @classmethod
+    def singleton(cls):
+        if cls._singleton is None:
+            cls._singleton = Text()
+        return cls._singleton
+
+    @classmethod
+    def log(cls, msg):
+        log_ex(msg, category=cls.__name__)
+
+    def __init__(self):
+        self.fonts   = {}               # size -> Font
+        self.strings = OrderedDict()    # (string, size, color) -> Surface
+
+    def font(self, size):
+        font = self.fonts.get(size)
+        if font is None:
+            font             = pygame.font.Font(None, size)
+            self.fonts[size] = font
+            Text.log(f"Font: size={size} height={font.get_height()}")
+        return font
+
+    # Return the surface of the string rendered by the font, without
+    # antialiasing, converted to the display format if any.
+    def render(self, string, size=SIZE, color=(0, 0, 0)):
+        key     = (string, size, tuple(color))
+        surface = self.strings.get(key)
+        if surface is None:
+            surface = self.font(size).render(string, False, color)
+            if pygame.display.get_surface() is not None:
+                surface = surface.convert_alpha()
+            self.strings[key] = surface
+            if len(self.strings) > Text.MAX_STRINGS:
+                self.strings.popitem(last=False)
+        else:
+            self.strings.move_to_end(key)
+        return surface
+
+    # Blit the string at the coordinates, and return the rectangle drawn on.
+    def blit(self, surface, string, x, y, size=SIZE, color=(0, 0, 0)):
+        return surface.blit(self.render(string, size, color), (x, y))
@@ -1,7 +1,14 @@
+import numpy as np
+import os.path
 import pygame
+import xml.etree.ElementTree as ET
 
+from collections       import OrderedDict
+from pytmx             import TiledTileLayer
 from pytmx.util_pygame import load_pygame as tmx_load
 
+from .arenafile import ArenaFile
+from .const     import OBSTACLE, WALKABLE
 from .resources import Resources
 from .utils     import log_ex
 
@@ -9,17 +16,43 @@ from .utils     import log_ex
 # self.height = pyxel.tilemap(self.tm).height
 # tileData = pyxel.tilemap(self.tm).pget(u, v)
 # return pyxel.tilemap(self.tm).get(self.u, self.v)
+#
+# A tilemap is stored in chunks of CHUNK_SIZE x CHUNK_SIZE squares:
+# - gids:      the (chunk rows, chunk columns, layers, CHUNK_SIZE, CHUNK_SIZE)
+#              GIDs of the tiles, 0 for no tile, the map padded with it.
+# - tiles:     the image of each GID, None for no tile.
+# - obstacles: OBSTACLE or WALKABLE, the is_obstacle property of each GID.
+#
+# Either decoded from the TMX file itself, or loaded from a compiled arena (see
+# `ArenaFile`, `sections`), in which case the GIDs of a chunk are read from
+# the file only when needed. The GIDs of the chunks used recently are kept
+# decoded in a LRU cache.
+#
+# Layers are drawn chunk by chunk: the tiles of a chunk are drawn once on a
+# surface of its own, then the surface is blitted as a whole. At zoom level N,
+# the surface is the one of level N-1 scaled down by half. The surfaces of the
+# chunks drawn recently are kept in a LRU cache per zoom level. Tiles do not
+# change once loaded, so a surface is never drawn again while cached.
 class Tilemap:
 
+    CHUNK_SIZE = 64     # Squares per chunk side.
+
     def log(msg):
         log_ex(msg, category="Tilemap")
 
-    def __init__(self, name):
-        path           = Resources.locate("tilemap", f"{name}.tmx")
-        self.tmx       = tmx_load(path)
-        (w,  h)        = self.get_map_size()
-        self.tile_size = (self.tmx.tilewidth, self.tmx.tileheight)
-        (tw, th)       = self.tile_size
+    def __init__(self, name, compiled=None, max_chunks=64, max_surfaces=16):
+        path              = Resources.locate("tilemap", f"{name}.tmx")
+        self.path         = path
+        self.chunks       = OrderedDict()   # (cu, cv) -> [[[gid, …], …], …]
+        self.max_chunks   = max_chunks
+        self.surfaces     = {}              # zoom -> (cu, cv, layer_index) -> Surface
+        self.max_surfaces = max_surfaces
+        if compiled is None:
+            self.decode(path)
+        else:
+            self.load(compiled)
+        (w,  h)         = self.get_map_size()
+        (tw, th)        = self.tile_size
         Tilemap.log(f"name={name} path={path} map_size={w}x{h} tile_size={tw}x{th}")
 
         if __debug__:
@@ -30,28 +63,203 @@ class Tilemap:
             if h < screen_height / th:
                 raise AssertionError("Invalid tilemap height")
 
-    # FIXME Re-implement building the obstacles matrix from the Tilemap class.
+    def decode(self, path):
+        tmx            = tmx_load(path)
+        self.tile_size = (tmx.tilewidth, tmx.tileheight)
+        self.map_size  = (tmx.width, tmx.height)
+        self.gids      = self.chunked(np.array([layer.data for layer in tmx.layers
+                                                if isinstance(layer, TiledTileLayer)],
+                                               dtype=np.uint32))
+        self.tiles     = [image or None for image in tmx.images]
+        self.obstacles = np.full(len(self.tiles), WALKABLE, dtype=np.uint8)
+        for (gid, props) in tmx.tile_properties.items():
+            if props["is_obstacle"]:
+                self.obstacles[gid] = OBSTACLE
+
+    # Return the (layers, height, width) GIDs split in chunks.
+    def chunked(self, gids):
+        c         = Tilemap.CHUNK_SIZE
+        (l, h, w) = gids.shape
+        (cw, ch)  = (-(-w // c), -(-h // c))
+        padded    = np.zeros((l, ch * c, cw * c), dtype=gids.dtype)
+        padded[:, :h, :w] = gids
+        return np.ascontiguousarray(padded.reshape(l, ch, c, cw, c).transpose(1, 3, 0, 2, 4))
+
+    def load(self, compiled):
+        info           = compiled.header["info"]
+        self.tile_size = tuple(info["tile_size"])
+        self.map_size  = tuple(info["map_size"])
+        self.gids      = compiled.array("gids")
+        self.obstacles = compiled.array("obstacles")
+        atlas          = compiled.array("tiles")
+        self.tiles     = [None if gid in info["no_tiles"] else ArenaFile.surface(atlas[gid])
+                          for gid in range(len(atlas))]
+
+    # Return the (atlas, no_tiles) of the tiles: the (GIDs, tile height, tile
+    # width, 4) RGBA pixels of each tile, transparent for no tile, and the GIDs
+    # of no tile.
+    def atlas(self):
+        (tw, th) = self.tile_size
+        atlas    = np.zeros((len(self.tiles), th, tw, 4), dtype=np.uint8)
+        no_tiles = []
+        for (gid, tile) in enumerate(self.tiles):
+            if tile is None:
+                no_tiles.append(gid)
+                continue
+            assert tile.get_size() == self.tile_size, "Tiles must have the map tile size"
+            atlas[gid] = ArenaFile.pixels(tile)
+        return (atlas, no_tiles)
+
+    # Return the (info, sections) of the tilemap to store in a compiled arena.
+    def sections(self):
+        (atlas, no_tiles) = self.atlas()
+        info              = {"tile_size":  list(self.tile_size),
+                             "map_size":   list(self.map_size),
+                             "chunk_size": Tilemap.CHUNK_SIZE,
+                             "no_tiles":   no_tiles}
+        sections          = {"gids": self.gids, "obstacles": self.obstacles, "tiles": atlas}
+        return (info, sections)
+
+    # Return the paths of the files the tilemap is made of: the TMX file, its
+    # external tilesets and their images.
+    def sources(self):
+        sources = [self.path]
+        queue   = [self.path]
+        while queue:
+            path = queue.pop(0)
+            base = os.path.dirname(path)
+            root = ET.parse(path).getroot()
+            for tileset in root.iter("tileset"):
+                source = tileset.get("source")
+                if source is not None:
+                    sources.append(os.path.join(base, source))
+                    queue.append(os.path.join(base, source))
+            for image in root.iter("image"):
+                sources.append(os.path.join(base, image.get("source")))
+        return sources
+
+    # Return the GIDs of the chunk, per layer, per row.
+    def chunk(self, cu, cv):
+        key  = (cu, cv)
+        gids = self.chunks.get(key)
+        if gids is None:
+            gids             = self.gids[cv, cu].tolist()
+            self.chunks[key] = gids
+            if len(self.chunks) > self.max_chunks:
+                self.chunks.popitem(last=False)
+        else:
+            self.chunks.move_to_end(key)
+        return gids
+
+    # Return the (cu, cv) chunks holding the squares of the rectangle, the
+    # squares out of the map excluded.
+    def chunks_of(self, rect):
+        c        = Tilemap.CHUNK_SIZE
+        (w, h)   = self.map_size
+        (u0, v0) = (max(0, rect.x),     max(0, rect.y))
+        (u1, v1) = (min(w, rect.right), min(h, rect.bottom))
+        if u0 >= u1 or v0 >= v1:
+            return []
+        return [(cu, cv) for cv in range(v0 // c, (v1 - 1) // c + 1)
+                         for cu in range(u0 // c, (u1 - 1) // c + 1)]
+
+    # Decode the chunks of the rectangle, and the ones around it, ahead of
+    # their use.
+    def prefetch(self, rect, margin=1):
+        c = Tilemap.CHUNK_SIZE
+        for (cu, cv) in self.chunks_of(rect.inflate(2 * margin * c, 2 * margin * c)):
+            self.chunk(cu, cv)
+
     def is_obstacle(self, u, v, layer_index):
-        props = self.tmx.get_tile_properties(u, v, layer_index)
-        return props["is_obstacle"]
+        c   = Tilemap.CHUNK_SIZE
+        gid = self.chunk(u // c, v // c)[layer_index][v % c][u % c]
+        return self.obstacles[gid] == OBSTACLE
+
+    # Return the (height, width) GIDs of the layer. Reads the whole layer.
+    def layer_gids(self, layer_index):
+        (w, h)            = self.map_size
+        (ch, cw, _, c, _) = self.gids.shape
+        gids              = self.gids[:, :, layer_index].transpose(0, 2, 1, 3)
+        return gids.reshape(ch * c, cw * c)[:h, :w]
 
-    def get_layer(self, layer_index):
-        return self.tmx.layers[layer_index]
+    # Return the obstacles matrix of the layer: a (height, width) array of
+    # WALKABLE and OBSTACLE bytes, the GIDs of the layer mapped at once through
+    # the obstacles of the tiles.
+    def obstacles_matrix(self, layer_index):
+        return self.obstacles[self.layer_gids(layer_index)]
+
+    # Return the strategic view of the tilemap, one pixel per square: the
+    # (height, width, 4) RGBA mean colors of the tiles of the squares, the
+    # tile of the upper layer drawn over the ones of the layers below.
+    def strategic_view(self):
+        (atlas, no_tiles)  = self.atlas()
+        (n, th, tw, _)     = atlas.shape
+        colors             = atlas.reshape(n, th * tw, 4).mean(axis=1).round().astype(np.uint8)
+        has_tile           = np.ones(n, dtype=bool)
+        has_tile[no_tiles] = False
+        (w, h)             = self.map_size
+        pixels             = np.zeros((h, w, 4), dtype=np.uint8)
+        for layer_index in range(self.gids.shape[2]):
+            gids         = self.layer_gids(layer_index)
+            mask         = has_tile[gids]
+            pixels[mask] = colors[gids[mask]]
+        return pixels
 
     def get_layer_size(self, layer_index):
-        layer = self.get_layer(layer_index)
-        return (layer.width, layer.height)
+        return self.map_size
 
     def get_map_size(self):
         return self.get_layer_size(0)
 
-    def blit_layer(self, rect, layer_index, surface):
-        (tw, th) = self.tile_size
-        verbose = False
-        for v in range(rect.y, rect.y + rect.h):
-            for u in range(rect.x, rect.x + rect.w):
-                tile = self.tmx.get_tile_image(u, v, layer_index)
+    # Return the surface of the layer of the chunk at the zoom level.
+    def chunk_surface(self, cu, cv, layer_index, zoom=0):
+        key      = (cu, cv, layer_index)
+        surfaces = self.surfaces.setdefault(zoom, OrderedDict())
+        surface  = surfaces.get(key)
+        if surface is not None:
+            surfaces.move_to_end(key)
+            return surface
+
+        if zoom >= 1:
+            surface = self.chunk_surface(cu, cv, layer_index, zoom - 1)
+            (w, h)  = surface.get_size()
+            surface = pygame.transform.smoothscale(surface, (w // 2, h // 2))
+        else:
+            surface = self.draw_chunk(cu, cv, layer_index)
+
+        surfaces[key] = surface
+        if len(surfaces) > self.max_surfaces:
+            surfaces.popitem(last=False)
+        return surface
+
+    # Return a surface with the tiles of the layer of the chunk drawn on it.
+    # Per pixel alpha is kept only if some square of the chunk has no tile or
+    # a tile with alpha.
+    def draw_chunk(self, cu, cv, layer_index):
+        c         = Tilemap.CHUNK_SIZE
+        (tw, th)  = self.tile_size
+        tiles     = self.tiles
+        surface   = pygame.Surface((c * tw, c * th), pygame.SRCALPHA)
+        is_opaque = True
+        for (j, row) in enumerate(self.chunk(cu, cv)[layer_index]):
+            for (i, gid) in enumerate(row):
+                tile = tiles[gid]
                 if tile is None:
+                    is_opaque = False
                     continue
-                tile_xy = ((u - rect.x) * tw, (v - rect.y) * th)
-                surface.blit(tile, tile_xy)
+                if tile.get_flags() & pygame.SRCALPHA:
+                    is_opaque = False
+                surface.blit(tile, (i * tw, j * th))
+        if is_opaque:
+            return surface.convert()
+        else:
+            return surface.convert_alpha()
+
+    # Blit the squares of the rectangle at the zoom level, at most one blit per
+    # chunk.
+    def blit_layer(self, rect, layer_index, surface, zoom=0):
+        c        = Tilemap.CHUNK_SIZE
+        (tw, th) = (self.tile_size[0] >> zoom, self.tile_size[1] >> zoom)
+        for (cu, cv) in self.chunks_of(rect):
+            surface.blit(self.chunk_surface(cu, cv, layer_index, zoom),
+                         ((cu * c - rect.x) * tw, (cv * c - rect.y) * th))
@@ -0,0 +1,36 @@
+import json
+import os
+import os.path
+import pytest
+import shutil
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.join(ROOT, "lib"))
+
+# Run headless, with the assets of the repository and its configuration, logs
+# disabled.
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("WF_DATA", ROOT)
+if "WF_CONF" not in os.environ:
+    conf = tempfile.mkdtemp(prefix="wf-conf-")
+    for name in ("engine.json", "input.json", "resources.json"):
+        shutil.copy(os.path.join(ROOT, "etc", name), conf)
+    with open(os.path.join(conf, "engine.json")) as f:
+        config = json.load(f)
+    config["screen"]["fullscreen"] = False
+    config["logs"]                 = []
+    with open(os.path.join(conf, "engine.json"), "w") as f:
+        json.dump(config, f)
+    os.environ["WF_CONF"] = conf
+
+# The engine is a singleton: a single one is shared by the tests.
+@pytest.fixture(scope="session")
+def engine():
+    from WeaponFactory.core import Engine
+    e = Engine(profiling=False)
+    yield e
+    e.quit()
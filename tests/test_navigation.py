@@ -0,0 +1,414 @@
+import numpy as np
+import random
+
+from math import sqrt
+
+from WeaponFactory.const      import OBSTACLE, WALKABLE
+from WeaponFactory.navigation import AStar, Components, DStarLite, HPAStar, JumpPointSearch, \
+                                     NavGrid, complete
+
+# Return the grid of the rows, "#" for obstacles.
+def grid_of(rows):
+    return NavGrid(np.array([[OBSTACLE if c == "#" else WALKABLE for c in row]
+                             for row in rows], dtype=np.uint8))
+
+# Return the connected components of the walkable squares, as a list of sets
+# of square indexes, by a plain flood fill.
+def flood_components(grid):
+    (w, h)     = (grid.width, grid.height)
+    seen       = set()
+    components = []
+    for i in range(w * h):
+        if grid.cells[i] != WALKABLE or i in seen:
+            continue
+        component = {i}
+        stack     = [i]
+        while stack:
+            j      = stack.pop()
+            (u, v) = (j % w, j // w)
+            for (du, dv) in Components.NEIGHBOURS:
+                (nu, nv) = (u + du, v + dv)
+                k        = nv * w + nu
+                if 0 <= nu < w and 0 <= nv < h and grid.cells[k] == WALKABLE \
+                   and k not in component:
+                    component.add(k)
+                    stack.append(k)
+        seen |= component
+        components.append(component)
+    return components
+
+# Connected squares share a label, the squares of a clean label are connected,
+# and the sizes are right.
+def check_labels(components):
+    grid = components.grid
+    for squares in flood_components(grid):
+        labels = {components.find(components.labels[i]) for i in squares}
+        assert len(labels) == 1
+        label  = labels.pop()
+        assert components.sizes[label] >= len(squares)
+        if label not in components.dirty:
+            assert components.sizes[label] == len(squares)
+    walkable = sum(1 for c in grid.cells if c == WALKABLE)
+    assert sum(components.sizes.values()) == walkable
+
+def occupy(grid, components, u, v):
+    if grid.occupy(u, v):
+        components.set_obstacle(u, v)
+
+def vacate(grid, components, u, v):
+    if grid.vacate(u, v):
+        components.set_walkable(u, v)
+
+def test_components_follow_random_changes(monkeypatch):
+    for seed in range(12):
+        rnd = random.Random(seed)
+        monkeypatch.setattr(Components, "MAX_SPLIT", rnd.choice([4, 32, 1024]))
+        rows       = ["".join("#" if rnd.random() < 0.3 else "." for u in range(24))
+                      for v in range(20)]
+        grid       = grid_of(rows)
+        components = Components(grid)
+        occupied   = []
+        relabel    = None
+        for step in range(200):
+            if occupied and rnd.random() < 0.4:
+                vacate(grid, components, *occupied.pop(rnd.randrange(len(occupied))))
+            else:
+                (u, v) = (rnd.randrange(grid.width), rnd.randrange(grid.height))
+                if grid.is_walkable(u, v):
+                    occupied.append((u, v))
+                    occupy(grid, components, u, v)
+
+            # Occupancy changes happen while relabelling.
+            if relabel is None and components.dirty:
+                relabel = components.relabel(slice=8)
+            for n in range(rnd.randint(0, 3)):
+                if relabel is not None and next(relabel, StopIteration) is StopIteration:
+                    relabel = None
+            check_labels(components)
+
+def test_blocking_a_doorway_splits_the_small_side():
+    grid       = grid_of(["......#.........",
+                          "......#.........",
+                          "................",
+                          "......#.........",
+                          "......#........."])
+    components = Components(grid)
+    assert components.is_reachable((0, 0), (15, 4))
+    occupy(grid, components, 6, 2)
+    assert components.dirty == set()
+    assert not components.is_reachable((0, 0), (15, 4))
+    assert components.label(0, 0) != components.label(15, 4)
+    vacate(grid, components, 6, 2)
+    assert components.is_reachable((0, 0), (15, 4))
+
+# Past MAX_SPLIT squares, the label is only marked dirty: queries answer that
+# a path may exist until the label is split in the background.
+def test_dirty_label_is_split_by_relabelling(monkeypatch):
+    monkeypatch.setattr(Components, "MAX_SPLIT", 16)
+    rows       = ["................"] * 8 + ["#######.########"] + ["................"] * 8
+    grid       = grid_of(rows)
+    components = Components(grid)
+    occupy(grid, components, 7, 8)
+    assert components.dirty == {components.label(0, 0)}
+    assert components.is_reachable((0, 0), (15, 16))
+
+    relabel = components.relabel(slice=8)
+    next(relabel)
+    occupy(grid, components, 3, 3)
+    complete(relabel)
+    assert components.dirty == set()
+    assert not components.is_reachable((0, 0), (15, 16))
+    check_labels(components)
+
+# Return the cost of the (u, v) hops from the start square, excluded.
+def cost_of(start, hops):
+    cost = 0.0
+    for (u, v) in hops:
+        cost += sqrt(2) if u != start[0] and v != start[1] else 1.0
+        start = (u, v)
+    return cost
+
+# Replan from the start square, moved along the path, after random occupancy
+# changes, and compare with fresh A* searches.
+def check_replans(seed):
+    rnd     = random.Random(seed)
+    (w, h)  = (rnd.randint(6, 24), rnd.randint(6, 24))
+    grid    = grid_of(["".join("#" if rnd.random() < 0.25 else "." for u in range(w))
+                       for v in range(h)])
+    astar   = AStar(grid)
+    squares = [(u, v) for v in range(h) for u in range(w) if grid.is_walkable(u, v)]
+    if len(squares) < 2:
+        return
+    (start, goal) = rnd.sample(squares, 2)
+    planner       = DStarLite(grid, start, goal)
+    grid.occupy(*start)
+    for step in range(25):
+        for n in range(rnd.randint(1, 4)):
+            (u, v) = rnd.choice(squares)
+            if (u, v) in (start, goal):
+                continue
+            if grid.is_walkable(u, v):
+                grid.occupy(u, v)
+            elif not grid.vacate(u, v):
+                continue
+            # Only the planners covering the square are touched, as by the
+            # compass.
+            if planner.covers(u, v):
+                planner.touch(u, v)
+
+        hops          = planner.replan(start)
+        (expected, _) = astar.find_path(start, goal)
+        assert (hops == []) == (expected == [])
+        assert abs(cost_of(start, hops) - cost_of(start, expected[1:])) < 1e-6
+
+        # The planner is told about its start square moving, as by the
+        # compass.
+        if len(hops) >= 2 and grid.is_walkable(*hops[0]):
+            grid.vacate(*start)
+            planner.touch(*start)
+            start = hops[0]
+            grid.occupy(*start)
+            planner.touch(*start)
+
+def test_replans_are_optimal():
+    for seed in range(400):
+        check_replans(seed)
+
+# Return a random grid of the seed, and its walkable squares.
+def random_grid(seed, obstacles=0.25):
+    rnd     = random.Random(seed)
+    (w, h)  = (rnd.randint(6, 40), rnd.randint(6, 40))
+    grid    = grid_of(["".join("#" if rnd.random() < obstacles else "." for u in range(w))
+                       for v in range(h)])
+    squares = [(u, v) for v in range(h) for u in range(w) if grid.is_walkable(u, v)]
+    return (rnd, grid, squares)
+
+# Past `AStar.SPARSE_SIZE` squares, the searches find the same paths and
+# costs with their scratch state in dictionaries.
+def test_sparse_scratch(monkeypatch):
+    for seed in range(100):
+        (rnd, grid, squares) = random_grid(seed)
+        if len(squares) < 2:
+            continue
+        dense = AStar(grid)
+        monkeypatch.setattr(AStar, "SPARSE_SIZE", 0)
+        sparse = AStar(grid)
+        monkeypatch.undo()
+        assert sparse.is_sparse and not dense.is_sparse
+        for n in range(5):
+            (start, end) = rnd.sample(squares, 2)
+            assert sparse.find_path(start, end) == dense.find_path(start, end)
+            bounds  = (0, 0, grid.width, grid.height)
+            targets = [grid.index(*square) for square in squares]
+            assert sparse.costs(start, targets, bounds) == dense.costs(start, targets, bounds)
+
+# Jump Point Search finds a path exactly when A* does, as short, of hops one
+# move apart.
+def test_jump_point_paths():
+    for seed in range(200):
+        (rnd, grid, squares) = random_grid(seed, [0.1, 0.25, 0.35][seed % 3])
+        if len(squares) < 2:
+            continue
+        astar = AStar(grid)
+        jps   = JumpPointSearch(grid)
+        for n in range(5):
+            (start, end)  = rnd.sample(squares, 2)
+            (expected, _) = astar.find_path(start, end)
+            (hops, _)     = jps.find_path(start, end)
+            assert (hops == []) == (expected == [])
+            if expected == []:
+                continue
+            assert hops[0] == start and hops[-1] == end
+            for ((u, v), (nu, nv)) in zip(hops, hops[1:]):
+                assert max(abs(nu - u), abs(nv - v)) == 1 and grid.is_walkable(nu, nv)
+            assert abs(cost_of(start, hops[1:]) - cost_of(start, expected[1:])) < 1e-6
+
+# HPA* finds a path whenever there is one. Refined segment by segment within
+# the window of their clusters, as by the compass, it costs at most 3 clusters
+# more than the shortest path, and at most 1.5 times as much when long enough
+# for the compass to search it.
+def test_hierarchical_paths(monkeypatch):
+    monkeypatch.setattr(HPAStar, "CLUSTER_SIZE", 4)
+    size = HPAStar.CLUSTER_SIZE
+    for seed in range(200):
+        (rnd, grid, squares) = random_grid(seed, [0.1, 0.25, 0.35][seed % 3])
+        if len(squares) < 2:
+            continue
+        astar = AStar(grid)
+        hpa   = HPAStar(grid, AStar(grid))
+        for n in range(5):
+            (start, end)  = rnd.sample(squares, 2)
+            (expected, _) = astar.find_path(start, end)
+            waypoints     = hpa.find_path(start, end)
+            assert (waypoints == []) == (expected == [])
+            if expected == []:
+                continue
+            cost = 0.0
+            for (a, b) in zip(waypoints, waypoints[1:]):
+                (hops, _) = astar.find_path(a, b, hpa.window(a, b))
+                assert hops != []
+                cost += cost_of(a, hops[1:])
+            optimal = cost_of(start, expected[1:])
+            assert cost <= optimal + 3 * size + 1e-6
+            if hpa.is_long(start, end):
+                assert cost <= 1.5 * optimal + 1e-6
+
+# Return a drone spawned on the square, updated by the engine if it walks.
+def spawn(engine, square, name, walks=False):
+    from WeaponFactory.arena import Arena
+    from WeaponFactory.drone import Drone
+    drone      = Drone(square)
+    drone.name = name
+    drone.register_observer(Arena.singleton())
+    drone.notify_observers("entity-spawned", square=square)
+    if walks:
+        engine.entities.append(drone)
+    return drone
+
+def walk(engine, entity, ticks=4000):
+    for n in range(ticks):
+        engine.tick()
+        if entity.nav_path.is_done() and entity.is_idle():
+            return
+
+# A unit standing on a waypoint of a long path, or on the end of the segment
+# being walked, does not stop the entity.
+def test_occupied_waypoints_are_skipped(engine):
+    from WeaponFactory.arena      import Square
+    from WeaponFactory.navigation import Compass
+    c      = Compass.singleton()
+    walker = spawn(engine, Square(40, 40), "W1", walks=True)
+    c.navigate(walker, Square(200, 180))
+    path   = walker.nav_path
+    while path.remaining() < 6 and not path.is_done():
+        engine.tick()
+    assert len(path.waypoints) >= 2
+    spawn(engine, c.unpack(path.hops[-1]), "X1")
+    spawn(engine, path.waypoints[0], "X2")
+    walk(engine, walker)
+    assert walker.square() == Square(200, 180)
+
+# A unit standing on the destination: the entity stops next to it.
+def test_occupied_destination(engine):
+    from WeaponFactory.arena      import Square
+    from WeaponFactory.navigation import Compass
+    c      = Compass.singleton()
+    walker = spawn(engine, Square(40, 60), "W2", walks=True)
+    c.navigate(walker, Square(190, 200))
+    spawn(engine, Square(190, 200), "X3")
+    walk(engine, walker)
+    square = walker.square()
+    assert max(abs(square.u - 190), abs(square.v - 200)) == 1
+
+# A group order replaces the flow field the group followed: only the fields
+# still followed are kept.
+def test_flow_fields_not_followed_are_dropped(engine):
+    from WeaponFactory.arena      import Square
+    from WeaponFactory.navigation import Compass
+    c     = Compass.singleton()
+    group = [spawn(engine, Square(60 + k, 100), f"G{k}", walks=True) for k in range(3)]
+    for goal in [Square(100, 100), Square(60, 140), Square(120, 60)]:
+        c.navigate_group(group, goal)
+        for n in range(20):
+            engine.tick()
+    assert len(c.flow_fields) == 1
+    assert all(e.nav_path.field is list(c.flow_fields.values())[0] for e in group)
+
+# Members a group field does not reach are queued as requests of their own,
+# not planned while the group request is advanced.
+def test_group_members_out_of_the_field_are_queued(engine, monkeypatch):
+    from WeaponFactory.arena      import Square
+    from WeaponFactory.navigation import Compass, FlowField
+    c     = Compass.singleton()
+    group = [spawn(engine, Square(60 + k, 160), f"H{k}", walks=True) for k in range(3)]
+    monkeypatch.setattr(FlowField, "reaches", lambda self, u, v: False)
+    c.request_group(group, Square(90, 160))
+    complete(c.requests[-1].search)
+    queued = [r.entities for r in list(c.requests)[-3:]]
+    assert sorted(e.name for (e,) in queued) == ["H0", "H1", "H2"]
+    assert all(e.nav_path.is_done() for e in group)
+    for entity in group:
+        walk(engine, entity)
+    assert Square(90, 160) in [e.square() for e in group]
+
+# The moves of an entity leave the cached path it follows valid, until it is
+# done with it.
+def test_cached_paths_are_exempt_while_followed(engine):
+    from WeaponFactory.arena      import Square
+    from WeaponFactory.navigation import Compass
+    c      = Compass.singleton()
+    walker = spawn(engine, Square(40, 80), "W3", walks=True)
+    c.navigate(walker, Square(70, 80))
+    key    = ((40, 80), (70, 80), c.finder.MOVEMENT)
+    assert walker.nav_path.cached == key
+    walk(engine, walker)
+    assert walker.square() == Square(70, 80)
+    assert walker.nav_path.cached is None
+    assert key in c.paths.paths
+    c.navigate(walker, Square(40, 80))
+    walk(engine, walker)
+    assert key not in c.paths.paths
+
+# Other units crossing a flow field are avoided locally: the field is neither
+# invalidated nor integrated again.
+def test_units_crossing_a_flow_field(engine, monkeypatch):
+    from WeaponFactory.arena      import Square
+    from WeaponFactory.navigation import Compass, FlowField
+    c     = Compass.singleton()
+    group = [spawn(engine, Square(60 + k, 130), f"F{k}", walks=True) for k in range(3)]
+    c.navigate_group(group, Square(100, 130))
+    field = group[0].nav_path.field
+    runs  = []
+    monkeypatch.setattr(FlowField, "integrate", lambda self, slice=None: runs.append(self))
+    other = spawn(engine, Square(75, 120), "O1", walks=True)
+    c.navigate(other, Square(75, 140))
+    walk(engine, other)
+    assert field.is_valid and runs == []
+    for entity in group:
+        walk(engine, entity)
+    assert Square(100, 130) in [e.square() for e in group]
+
+# Refining, repairing and planning again are queued: no search runs while the
+# entities are updated, out of the planning budget.
+def test_replans_are_queued(engine, monkeypatch):
+    from WeaponFactory.arena      import Square
+    from WeaponFactory.navigation import Compass, FlowField
+    c        = Compass.singleton()
+    in_scene = []
+    def guard(f):
+        def guarded(*args, **kwargs):
+            assert not in_scene, f"{f.__qualname__} run out of the planning budget"
+            return f(*args, **kwargs)
+        return guarded
+    for (cls, name) in [(AStar, "search"), (DStarLite, "search"), (FlowField, "integrate")]:
+        monkeypatch.setattr(cls, name, guard(getattr(cls, name)))
+    update_scene = engine.update_scene
+    def scene():
+        in_scene.append(True)
+        update_scene()
+        in_scene.pop()
+    monkeypatch.setattr(engine, "update_scene", scene)
+
+    walker = spawn(engine, Square(30, 220), "W4", walks=True)
+    c.navigate(walker, Square(200, 220))
+    path   = walker.nav_path
+    while path.remaining() < 8:
+        engine.tick()
+    assert len(path.waypoints) >= 2
+    spawn(engine, c.unpack(path.hops[path.cursor + 2]), "X4")
+    spawn(engine, path.waypoints[0], "X5")
+    walk(engine, walker)
+    assert walker.square() == Square(200, 220)
+
+# A click picks the entity the nearest to the square, if close enough, and a
+# rectangle the first entity of each of its squares.
+def test_region_picks(engine):
+    from WeaponFactory.arena import Region, Square
+    near   = spawn(engine, Square(20, 110), "P1")
+    far    = spawn(engine, Square(24, 110), "P2")
+    region = Region.singleton()
+    for (start, end, expected) in [((21, 111), (21, 111), [near]),
+                                   ((22, 110), (22, 110), []),
+                                   ((19, 109), (24, 112), [near, far])]:
+        (region.start, region.end, region.is_enabled) = (Square(*start), Square(*end), True)
+        assert region.disable() == expected